@@ -1,14 +1,44 @@
+import hashlib
 import os
+import random
+import time
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, url_for, Markup)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import (exists, func, inspect, literal, select, true,
+                        tuple_)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
+from sqlalchemy.orm import (joinedload, load_only, make_transient_to_detached,
+                            selectinload)
+from sqlalchemy.pool import QueuePool
+
+from assets import assets, build as build_static_assets
+from cache import LRUCache
 
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Likes
+from models import (db, connect_db, User, Message, Likes, Follows,
+                    TimelineEntry, TrendingMessage)
+import migrations
+from jobs import jobs
+from metrics import metrics
+from passwords import hasher, PasswordHasherBusy
+from reads import reads
 
 CURR_USER_KEY = "curr_user"
 
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 60
+
+# how many messages the trending page shows
+TRENDING_LENGTH = 50
+
+# all that the user cards on /users show
+USER_CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -20,26 +50,594 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Database connections each process keeps (DB_POOL_SIZE) and may open on
+# top of those when busy (DB_MAX_OVERFLOW). A request waits up to
+# DB_POOL_TIMEOUT seconds for one to come free, then gets a 503; set it
+# low to shed load quickly rather than queue. Connections are replaced
+# after DB_POOL_RECYCLE seconds, and checked before use unless
+# DB_POOL_PRE_PING is 0. The same settings apply to each replica. Sizes
+# and timeouts only mean something to a queue pool, so databases that
+# don't use one (such as SQLite) ignore them.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': bool(int(os.environ.get('DB_POOL_PRE_PING', 1))),
+}
+
+_database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+if issubclass(_database_url.get_dialect().get_pool_class(_database_url),
+              QueuePool):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    })
+
+# Longest a single SQL statement may run, in milliseconds, for requests
+# that only read (GET/HEAD) and for the rest (0 for no limit)
+app.config['STATEMENT_TIMEOUT_MS_READ'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS_READ', 0))
+app.config['STATEMENT_TIMEOUT_MS_WRITE'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS_WRITE', 0))
+
+# Threads for running a page's independent queries side by side (see
+# reads.py); 0 runs them one after another. Each can hold a database
+# connection, so leave room for them in DB_POOL_SIZE.
+app.config['CONCURRENT_READS'] = int(os.environ.get('CONCURRENT_READS', 0))
+
+# Queue follow-up work (fanning out messages, backfilling timelines,
+# purging big accounts) for `flask run-jobs` to do, instead of doing it in
+# the request. Failed jobs are retried JOB_MAX_ATTEMPTS times, waiting
+# JOB_RETRY_SECONDS and doubling.
+app.config['JOB_QUEUE'] = bool(int(os.environ.get('JOB_QUEUE', 0)))
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_LEASE_SECONDS'] = int(
+    os.environ.get('JOB_LEASE_SECONDS', 300))
+app.config['JOB_RETRY_SECONDS'] = int(os.environ.get('JOB_RETRY_SECONDS', 5))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+
+# The trending leaderboard keeps the top TRENDING_KEEP messages, dropping
+# any whose decayed like count falls below TRENDING_MIN_LIKES; a random
+# TRENDING_COMPACT_SHARE of likes and unlikes queue a job to clear out the
+# rest
+app.config['TRENDING_KEEP'] = int(os.environ.get('TRENDING_KEEP', 1000))
+app.config['TRENDING_MIN_LIKES'] = float(
+    os.environ.get('TRENDING_MIN_LIKES', 0.05))
+app.config['TRENDING_COMPACT_SHARE'] = float(
+    os.environ.get('TRENDING_COMPACT_SHARE', 0.01))
+
+# Accounts with more rows than this (messages, follows, likes and timeline
+# entries) are purged a chunk at a time after the request, by a job or,
+# with JOB_QUEUE off, on a background thread
+app.config['PURGE_IN_BACKGROUND_OVER'] = int(
+    os.environ.get('PURGE_IN_BACKGROUND_OVER', 5000))
+
+# How many logged-in users to keep cached between requests, and for how
+# many seconds. Each process has its own cache and write routes only clear
+# their own, so other processes may show stale profile data for up to TTL.
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+
+# How many rendered messages to keep for reuse (see message_fragment)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+
+# bcrypt work factor for new password hashes; logins rehash older ones
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Hashes run on a shared pool: this many at once (default one per core),
+# this many more waiting, and requests beyond that get a 503 after waiting
+# this long for room
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 0)) or None
+app.config['PASSWORD_HASH_QUEUE'] = (
+    int(os.environ['PASSWORD_HASH_QUEUE'])
+    if 'PASSWORD_HASH_QUEUE' in os.environ else None)
+app.config['PASSWORD_HASH_WAIT'] = float(
+    os.environ.get('PASSWORD_HASH_WAIT', 0.1))
+
+# Read-only replicas of the database, as comma separated URLs. Requests
+# that only read (GET/HEAD) use one of them, except for a user who has
+# written (POSTed) in the last READ_YOUR_WRITES_SECONDS: they stay on the
+# primary, so they see their own changes despite replication lag.
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{i}': url
+    for i, url in enumerate(
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url)
+}
+app.config['DATABASE_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['READ_YOUR_WRITES_SECONDS'] = int(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+
+# Record request/SQL metrics and serve them at /metrics, and log any SQL
+# statement slower than SLOW_QUERY_MS (0 for neither)
+app.config['METRICS_ENABLED'] = bool(int(os.environ.get('METRICS_ENABLED', 0)))
+# Bearer token the scraper must send for /metrics; without one, nobody may
+# read it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 0))
+
+# Send the old blanket "never cache anything" headers instead of per-route
+# cache policy; handy while editing templates and static files
+app.config['NO_HTTP_CACHE'] = bool(int(os.environ.get('NO_HTTP_CACHE', 0)))
+
+# How long browsers may reuse static files requested without a ?v= version
+app.config['STATIC_MAX_AGE'] = int(os.environ.get('STATIC_MAX_AGE', 3600))
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = app.config['STATIC_MAX_AGE']
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+hasher.init_app(app)
+assets.init_app(app)
+reads.init_app(app)
+jobs.init_app(app)
+metrics.init_app(app, {
+    'primary': db.get_engine(app),
+    **{replica: db.get_engine(app, bind=replica)
+       for replica in app.config['DATABASE_REPLICAS']},
+})
+
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                      ttl=app.config['USER_CACHE_TTL'])
+
+fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+
+##############################################################################
+# Pagination helpers
+#
+# Message lists are paged newest-first by seeking past the last
+# (timestamp, id) shown, rather than with OFFSET, so an old page costs the
+# same as the first one.
+
+
+def parse_cursor(cursor):
+    """Turn a `before=` cursor into a (timestamp, id) pair.
+
+    Returns None when there is no cursor (first page); 400s if malformed.
+    """
+
+    if not cursor:
+        return None
+
+    timestamp, _, msg_id = cursor.rpartition('_')
+
+    try:
+        return datetime.fromisoformat(timestamp), int(msg_id)
+    except ValueError:
+        abort(400)
+
+
+def page_cursor(messages, has_more):
+    """Cursor for the page after `messages`, or None if this is the last."""
+
+    if not (messages and has_more):
+        return None
+
+    last = messages[-1]
+    return format_cursor(last.timestamp, last.id)
+
+
+def format_cursor(timestamp, row_id):
+    """A `before=` cursor for the row after (`timestamp`, `row_id`)."""
+
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def keyset_page(query, timestamp_col, id_col, before,
+                limit=MESSAGES_PER_PAGE):
+    """Get one page of the message `query`, newest first, starting after
+    `before`.
+
+    Returns (messages, has_more).
+    """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    messages = (query
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(limit + 1)
+                .all())
+
+    return messages[:limit], len(messages) > limit
+
+
+def timeline_page(user, before):
+    """Get one page of `user`'s home timeline. Returns (messages, has_more).
+
+    Reads the precomputed timeline when it has been built for this user. It
+    only keeps the newest entries, so once it runs out (or if it was never
+    built) messages come from querying the followed users directly, unless
+    it is known to hold every message.
+    """
+
+    messages = []
+
+    if user.timeline_ready:
+        messages, has_more = keyset_page(
+            (Message
+             .query
+             .options(selectinload(Message.user))
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == user.id)),
+            TimelineEntry.timestamp, TimelineEntry.message_id, before)
+
+        if has_more or user.timeline_complete:
+            return messages, has_more
+
+        if messages:
+            before = (messages[-1].timestamp, messages[-1].id)
+
+    followed_ids = (select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == user.id))
+
+    older, has_more = keyset_page(
+        (Message
+         .query
+         .options(selectinload(Message.user))
+         .filter((Message.user_id == user.id)
+                 | Message.user_id.in_(followed_ids))),
+        Message.timestamp, Message.id, before,
+        limit=MESSAGES_PER_PAGE - len(messages))
+
+    return messages + older, has_more
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in `text` so it matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def user_search_page(search, after):
+    """Get one page of users whose username contains `search`.
+
+    Usernames starting with the search come first, then those merely
+    containing it, each group in username order. `after` is the cursor
+    from the previous page ("<group>:<username>").
+
+    Returns (users, next_cursor).
+    """
+
+    group, last_username = 0, None
+
+    if after:
+        group, _, last_username = after.partition(':')
+        if group not in ('0', '1'):
+            abort(400)
+        group = int(group)
+
+    if search:
+        username = func.lower(User.username)
+        pattern = escape_like(search.lower())
+        starts_with = username.like(f"{pattern}%", escape='\\')
+        groups = [starts_with,
+                  username.like(f"%{pattern}%", escape='\\') & ~starts_with]
+    else:
+        groups = [true()]
+
+    # each group is its own query, so prefix matches can use the index
+    page = []
+    for rank in range(group, len(groups)):
+        users = (User
+                 .query
+                 .options(load_only(*USER_CARD_COLUMNS))
+                 .filter(groups[rank]))
+
+        if rank == group and last_username is not None:
+            users = users.filter(User.username > last_username)
+
+        found = (users
+                 .order_by(User.username)
+                 .limit(USERS_PER_PAGE + 1 - len(page))
+                 .all())
+        page.extend((rank, user) for user in found)
+
+        if len(page) > USERS_PER_PAGE:
+            break
+
+    next_cursor = None
+    if len(page) > USERS_PER_PAGE:
+        page = page[:USERS_PER_PAGE]
+        rank, last_user = page[-1]
+        next_cursor = f"{rank}:{last_user.username}"
+
+    return [user for _, user in page], next_cursor
+
+
+def follow_page(user_id, listed, owner, after, viewer_id):
+    """Get one page of the users on one side of `user_id`'s follows.
+
+    `listed` and `owner` are the Follows columns for the users to list and
+    for `user_id` (eg Follows.user_being_followed_id and
+    Follows.user_following_id for who they follow). Users come in id
+    order, which the follows indexes already keep; `after` is the last id
+    on the previous page. Whether user `viewer_id` follows each listed user
+    comes back from the same query.
+
+    Returns (users, followed_ids, next_cursor).
+    """
+
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        abort(400)
+
+    if viewer_id is not None:
+        viewer_follows = Follows.__table__.alias('viewer_follows')
+        followed = exists().where(
+            (viewer_follows.c.user_following_id == viewer_id)
+            & (viewer_follows.c.user_being_followed_id == User.id))
+    else:
+        followed = literal(False)
+
+    query = (db.session
+             .query(User, followed.label('followed'))
+             .options(load_only(*USER_CARD_COLUMNS))
+             .join(Follows, listed == User.id)
+             .filter(owner == user_id))
+
+    if after is not None:
+        query = query.filter(listed > after)
+
+    rows = query.order_by(listed).limit(USERS_PER_PAGE + 1).all()
+
+    next_cursor = None
+    if len(rows) > USERS_PER_PAGE:
+        rows = rows[:USERS_PER_PAGE]
+        next_cursor = rows[-1][0].id
+
+    return ([user for user, _ in rows],
+            {user.id for user, followed in rows if followed},
+            next_cursor)
+
+
+##############################################################################
+# Message fragments
+#
+# Message lists show the same <li> for a message on every page and to every
+# viewer, apart from the like button. That shared part is rendered once and
+# kept in fragment_cache.
+
+
+@app.template_global()
+def message_fragment(msg):
+    """The viewer-independent HTML for `msg` in a message list."""
+
+    author = msg.user
+
+    # messages can't be edited, so only the author's profile can change
+    # what's shown. Keying on it too means other processes, which don't see
+    # forget_author_fragments(), still never show an outdated profile.
+    key = (msg.id, author.id, author.username, author.image_url)
+
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(app.jinja_env
+                      .get_template('messages/item.html')
+                      .render(msg=msg))
+        fragment_cache.set(key, html)
+
+    return html
+
+
+def forget_author_fragments(user_id):
+    """Drop this process's cached fragments for messages by `user_id`."""
+
+    fragment_cache.delete_matching(lambda key, html: key[1] == user_id)
+
+
+##############################################################################
+# HTTP caching helpers
+#
+# Profiles and single messages get a strong ETag computed from everything
+# the page shows, before rendering it, so a browser or proxy that already
+# has that version gets a bodyless 304 Not Modified. Other pages are
+# personalized and only cached privately (see add_cache_headers).
+
+# a year: the most HTTP caches honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def files_version(directory):
+    """Hash of every file under `directory`, to spot a changed deploy."""
+
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(directory)):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(path.encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+# changing a template changes every page, whatever the data says
+TEMPLATES_VERSION = files_version(
+    os.path.join(app.root_path, app.template_folder))
+
+
+def viewer_state(*users):
+    """What of the logged in user's state a page shows: who they are (for
+    the navbar) and whether they follow each of `users`."""
+
+    if not g.user:
+        return None
+
+    return (g.user.id, g.user.username, g.user.image_url,
+            tuple(g.user.is_following(user) for user in users))
+
+
+def page_etag(*parts):
+    """A strong ETag for a page rendered from `parts`."""
+
+    content = repr((TEMPLATES_VERSION, assets.version, request.full_path)
+                   + parts)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Note `etag` as this response's ETag. If the client already has
+    that version, return a 304 to send instead of rendering the page."""
+
+    g.etag = etag
+
+    # rendering shows (and uses up) pending flash messages
+    if session.get('_flashes'):
+        return None
+
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304)
+
+    return None
+
+
+@app.template_global()
+def static_url(filename):
+    """URL for a static file, versioned by its content so browsers can
+    cache it forever (see add_cache_headers).
+
+    Once `flask build-assets` has run, that's the fingerprinted and
+    precompressed copy; until then, the original with a ?v= version.
+    """
+
+    built = assets.built_name(filename)
+    if built:
+        return url_for('assets', filename=built)
+
+    path = os.path.join(app.static_folder, filename)
+    return url_for('static', filename=filename,
+                   v=static_version(path, os.path.getmtime(path)))
+
+
+_static_versions = {}
+
+
+def static_version(path, mtime):
+    """Short content hash of the static file at `path`."""
+
+    key = (path, mtime)
+    if key not in _static_versions:
+        with open(path, 'rb') as f:
+            _static_versions[key] = hashlib.sha1(f.read()).hexdigest()[:12]
+
+    return _static_versions[key]
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+@app.before_request
+def choose_database():
+    """Send this request's reads to a replica, if it's safe to."""
+
+    replicas = app.config['DATABASE_REPLICAS']
+    if not replicas or request.method not in ('GET', 'HEAD'):
+        return
+
+    # session cookie marker set by note_write() below
+    wrote_at = session.get('wrote_at', 0)
+    if time.time() - wrote_at < app.config['READ_YOUR_WRITES_SECONDS']:
+        return
+
+    g.db_replica = random.choice(replicas)
+
+
+@app.before_request
+def limit_statements():
+    """Pick the statement timeout for this kind of request."""
+
+    if request.method in ('GET', 'HEAD'):
+        g.statement_timeout_ms = app.config['STATEMENT_TIMEOUT_MS_READ']
+    else:
+        g.statement_timeout_ms = app.config['STATEMENT_TIMEOUT_MS_WRITE']
+
+
+@app.after_request
+def note_write(response):
+    """Pin this user to the primary for a while after they write.
+
+    Every POST here writes something, so it's simpler to mark them all
+    than to remember to in each route.
+    """
+
+    if (app.config['DATABASE_REPLICAS'] and request.method == 'POST'
+            and response.status_code < 400):
+        session['wrote_at'] = time.time()
+
+    return response
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
-    # why not this? g.user = User.query.get(session.get[CURR_USER_KEY], None) 
+
+def load_current_user(user_id):
+    """Get the logged-in user, from `user_cache` if we can.
+
+    The cache holds a detached copy of the user's columns plus the ids of
+    who they follow and what they've liked. Merging that copy into this
+    request's session doesn't touch the database.
+    """
+
+    cached = user_cache.get(user_id)
+
+    if cached is not None:
+        snapshot, following_ids, liked_message_ids = cached
+        user = db.session.merge(snapshot, load=False)
+        user._following_ids = set(following_ids)
+        user._liked_message_ids = set(liked_message_ids)
+        return user
+
+    user = User.query.get(user_id)
+
+    if user is not None:
+        # the password hash is left out, so it's always read fresh from the
+        # database (eg by User.authenticate) rather than from a stale copy
+        snapshot = User(**{attr.key: getattr(user, attr.key)
+                           for attr in inspect(User).column_attrs
+                           if attr.key != 'password'})
+        make_transient_to_detached(snapshot)
+
+        user_cache.set(user_id, (snapshot,
+                                 frozenset(user.following_ids),
+                                 frozenset(user.liked_message_ids)))
+
+    return user
+
+
+def forget_cached_users(*user_ids):
+    """Drop users from `user_cache` after changing their data."""
+
+    user_cache.delete(*user_ids)
+
+
+def forget_cached_likers(message_id):
+    """Drop cached users who liked `message_id`.
+
+    This looks at each cached user rather than loading the likers, so it is
+    bounded by USER_CACHE_SIZE however popular the message was.
+    """
+
+    user_cache.delete_matching(
+        lambda user_id, cached: message_id in cached[2])
+
 
 def do_login(user):
     """Log in user."""
@@ -101,6 +699,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password if authenticate rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -128,34 +728,53 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    an 'after' cursor to continue from a previous page.
     """
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users, next_cursor = user_search_page(search, request.args.get('after'))
+
+    followed_ids = set()
+    if g.user:
+        followed_ids = g.user.following_among(user.id for user in users)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search,
+                           next_cursor=next_cursor, followed_ids=followed_ids)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    before = parse_cursor(request.args.get('before'))
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # snagging messages in order from the database, alongside the user;
+    # user.messages won't be in order by default. They are all by `user`,
+    # which is loaded too, so msg.user needs no eager loading here
+    user, (messages, has_more) = reads.run(
+        lambda: User.query.get_or_404(user_id),
+        lambda: keyset_page(
+            Message.query.filter(Message.user_id == user_id),
+            Message.timestamp, Message.id, before))
+
+    viewer_likes = (g.user.liked_among(msg.id for msg in messages)
+                    if g.user else set())
+
+    # messages never change, so their ids stand in for them
+    unchanged = not_modified(page_etag(
+        'users_show',
+        [getattr(user, column.key) for column in User.__table__.columns
+         if column.key != 'password'],
+        [msg.id for msg in messages], has_more,
+        viewer_state(user), sorted(viewer_likes)))
+    if unchanged:
+        return unchanged
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           likes=viewer_likes,
+                           next_cursor=page_cursor(messages, has_more))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -166,8 +785,17 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    viewer_id = g.user.id
+    after = request.args.get('after')
+
+    user, (users, followed_ids, next_cursor) = reads.run(
+        lambda: User.query.get_or_404(user_id),
+        lambda: follow_page(user_id, Follows.user_being_followed_id,
+                            Follows.user_following_id, after, viewer_id))
+
+    return render_template('users/following.html', user=user, users=users,
+                           followed_ids=followed_ids,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -178,8 +806,17 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    viewer_id = g.user.id
+    after = request.args.get('after')
+
+    user, (users, followed_ids, next_cursor) = reads.run(
+        lambda: User.query.get_or_404(user_id),
+        lambda: follow_page(user_id, Follows.user_following_id,
+                            Follows.user_being_followed_id, after, viewer_id))
+
+    return render_template('users/followers.html', user=user, users=users,
+                           followed_ids=followed_ids,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -192,7 +829,13 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    jobs.enqueue('backfill_timeline',
+                 key=f'backfill_timeline:{g.user.id}:{followed_user.id}',
+                 user_id=g.user.id, author_id=followed_user.id)
+    User.adjust_count(User.following_count, 1, User.id == g.user.id)
+    User.adjust_count(User.followers_count, 1, User.id == followed_user.id)
     db.session.commit()
+    forget_cached_users(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -207,7 +850,11 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    TimelineEntry.remove_author(g.user.id, followed_user.id)
+    User.adjust_count(User.following_count, -1, User.id == g.user.id)
+    User.adjust_count(User.followers_count, -1, User.id == followed_user.id)
     db.session.commit()
+    forget_cached_users(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -231,6 +878,8 @@ def profile():
         g.user.bio = form.bio.data
 
         db.session.commit()
+        forget_cached_users(g.user.id)
+        forget_author_fragments(g.user.id)
 
         flash("Profile updated.", "success")
         return redirect(f"/users/{g.user.id}")
@@ -247,26 +896,69 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+
+    if g.user.footprint > app.config['PURGE_IN_BACKGROUND_OVER']:
+        # gone as far as anyone can tell, before the purge even starts
+        g.user.release_identity()
+        jobs.enqueue('purge_user', key=f'purge_user:{user_id}',
+                     background=True, user_id=user_id)
+    else:
+        g.user.release_counts()
+        db.session.delete(g.user)
+
     db.session.commit()
+    forget_cached_users(user_id)
 
     return redirect("/signup")
 
+def likes_page(user_id, before, viewer_id):
+    """Get one page of the messages `user_id` liked, most recently liked
+    first, with their authors.
+
+    Whether user `viewer_id` liked each one comes back from the same query.
+
+    Returns (messages, viewer_likes, next_cursor), where viewer_likes is
+    the set of ids of the messages on the page that the viewer liked.
+    """
+
+    viewer_likes = Likes.__table__.alias('viewer_likes')
+    liked = exists().where((viewer_likes.c.user_id == viewer_id)
+                           & (viewer_likes.c.message_id == Message.id))
+
+    rows, has_more = keyset_page(
+        (db.session
+         .query(Message, Likes.created_at, Likes.id, liked.label('liked'))
+         .options(joinedload(Message.user))
+         .join(Likes, Likes.message_id == Message.id)
+         .filter(Likes.user_id == user_id)),
+        Likes.created_at, Likes.id, before)
+
+    next_cursor = None
+    if rows and has_more:
+        _, liked_at, like_id, _ = rows[-1]
+        next_cursor = format_cursor(liked_at, like_id)
+
+    return ([msg for msg, _, _, _ in rows],
+            {msg.id for msg, _, _, liked in rows if liked},
+            next_cursor)
+
+
 @app.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     "Show messages the user_id user has liked"
 
     if g.user:
-        target_user = User.query.get_or_404(user_id)
-        
-        list_liked_msg_ids = [l.id for l in target_user.likes]
+        viewer_id = g.user.id
+        before = parse_cursor(request.args.get('before'))
 
-        messages = (Message
-                    .query
-                    .filter(Message.id.in_(list_liked_msg_ids))
-                    .order_by(Message.timestamp.desc())
-                    .all())
-        return render_template('users/likes.html', messages=messages, user=target_user, likes=list_liked_msg_ids)
+        target_user, (messages, viewer_likes, next_cursor) = reads.run(
+            lambda: User.query.get_or_404(user_id),
+            lambda: likes_page(user_id, before, viewer_id))
+
+        return render_template('users/likes.html', messages=messages,
+                               user=target_user, likes=viewer_likes,
+                               next_cursor=next_cursor)
 
     else:
         flash("Access unauthorized.", "danger")
@@ -292,7 +984,14 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        # the author sees it straight away; followers get it from a job
+        TimelineEntry.deliver(
+            msg, select([literal(g.user.id).label('user_id')]))
+        jobs.enqueue('fan_out_message', message_id=msg.id)
+        User.adjust_count(User.messages_count, 1, User.id == g.user.id)
         db.session.commit()
+        forget_cached_users(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -303,7 +1002,19 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+    author = msg.user
+
+    unchanged = not_modified(page_etag(
+        'messages_show', msg.id,
+        (author.id, author.username, author.image_url),
+        viewer_state(author)))
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -315,36 +1026,79 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+
+    if author_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    User.adjust_count(User.messages_count, -1, User.id == g.user.id)
+    User.adjust_count(User.likes_count, -1, User.id.in_(
+        select([Likes.user_id]).where(Likes.message_id == message_id)))
+
+    # its likes and timeline entries go too, by ON DELETE CASCADE
+    Message.query.filter(Message.id == message_id).delete(
+        synchronize_session=False)
     db.session.commit()
+    forget_cached_users(g.user.id)
+    forget_cached_likers(message_id)
 
     return redirect(f"/users/{g.user.id}")
     
 @app.route('/messages/<int:msg_id>/like', methods=["POST"])
 def like_user(msg_id):
+    """Like a message for the current user, or unlike it if already liked."""
 
     if not g.user: 
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    if msg_id not in [m.id for m in g.user.messages]:
-        list_liked_msg_ids = [l.id for l in g.user.likes]
-        if msg_id in list_liked_msg_ids:
-            like = Likes.query.filter(Likes.user_id == g.user.id, Likes.message_id == msg_id).first()
-            db.session.delete(like)
-            db.session.commit()
+    liked, liked_at = Likes.toggle(g.user.id, msg_id)
+
+    if liked is None:
+        msg = Message.query.get_or_404(msg_id)
+
+        if msg.user_id == g.user.id:  # No allowing user to like their own message
+            flash("Sorry, you can't like your own messages.", "warning")
+
+    else:
+        User.adjust_count(User.likes_count, 1 if liked else -1,
+                          User.id == g.user.id)
+        if liked:
+            TrendingMessage.add_like(msg_id, liked_at)
         else:
-            likes = Likes(user_id=g.user.id, message_id=msg_id)
-            db.session.add(likes)
-            db.session.commit()
-        return redirect(request.referrer)
+            TrendingMessage.remove_like(msg_id, liked_at)
+        if random.random() < app.config['TRENDING_COMPACT_SHARE']:
+            jobs.enqueue('compact_trending', key='compact_trending')
+        db.session.commit()
+        forget_cached_users(g.user.id)
+
+    return redirect(request.referrer or "/")
+
+
+@app.route('/trending')
+def trending():
+    """Show the messages with the most likes lately."""
+
+    messages = (Message
+                .query
+                .options(joinedload(Message.user))
+                .join(TrendingMessage,
+                      TrendingMessage.message_id == Message.id)
+                .order_by(TrendingMessage.score.desc())
+                .limit(TRENDING_LENGTH)
+                .all())
+
+    likes = (g.user.liked_among(msg.id for msg in messages)
+             if g.user else set())
+
+    return render_template('messages/trending.html', messages=messages,
+                           likes=likes)
 
-    else:  # No allowing user to like their own message
-        flash("Sorry, you can't like your own messages.", "warning")
-        return redirect(request.referrer)
-        
-       
 
 ##############################################################################
 # Homepage and error pages
@@ -355,42 +1109,238 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        followers_list = [u.id for u in g.user.following]
-        followers_list.append(g.user.id)
+        user = g.user
+        before = parse_cursor(request.args.get('before'))
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followers_list))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        # the like set came with the user (see load_current_user)
+        messages, has_more = timeline_page(user, before)
+        list_liked_msg_ids = user.liked_message_ids
 
-        list_liked_msg_ids = [l.id for l in g.user.likes]
-        return render_template('home.html', messages=messages, user=g.user, likes=list_liked_msg_ids)
+        return render_template('home.html', messages=messages, user=g.user,
+                               likes=list_liked_msg_ids,
+                               next_cursor=page_cursor(messages, has_more))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    return ("Warbler is busy right now. Please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    """No database connection came free in time: shed the request."""
+
+    db.session.remove()
+    return ("Warbler is busy right now. Please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Jobs (see jobs.py). These may run more than once, so each is written to
+# be harmless the second time.
+
+
+@jobs.task
+def fan_out_message(message_id):
+    """Deliver a new message to its author's followers' timelines."""
+
+    msg = Message.query.get(message_id)
+    if msg is not None:
+        TimelineEntry.fan_out(msg)
+
+
+@jobs.task
+def backfill_timeline(user_id, author_id):
+    """Copy a newly followed user's messages into the follower's timeline."""
+
+    # skip it if they've unfollowed since
+    if Follows.query.get((author_id, user_id)) is not None:
+        TimelineEntry.backfill(user_id, author_id)
+
+
+@jobs.task
+def purge_user(user_id):
+    """Delete a user's rows a chunk at a time, then the user.
+
+    Each chunk is its own short transaction, so other writers aren't held
+    up behind one huge delete.
+    """
+
+    while User.purge_chunk(user_id):
+        db.session.commit()
+
+    user = User.query.get(user_id)
+    if user is not None:
+        user.release_counts()
+        db.session.delete(user)
+
+    forget_cached_users(user_id)
+
+
+@jobs.task
+def compact_trending():
+    """Keep the trending leaderboard to its top messages."""
+
+    TrendingMessage.compact(app.config['TRENDING_KEEP'],
+                            app.config['TRENDING_MIN_LIKES'])
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=1, help="Worker threads to run.")
+@click.option('--once', is_flag=True,
+              help="Run the jobs that are due, then exit.")
+def run_jobs(workers, once):
+    """Run queued jobs (see jobs.py) until interrupted."""
+
+    if once:
+        click.echo(f"Ran {jobs.run_pending()} jobs.")
+        return
+
+    jobs.start(workers)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        click.echo("Finishing running jobs...")
+        jobs.stop()
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--all', 'rebuild_all', is_flag=True,
+              help="Rebuild every timeline, not just ones never built.")
+def rebuild_timelines(rebuild_all):
+    """Build precomputed home timelines from existing messages and follows.
+
+    Run after deploying timelines (or restoring data) so homepages stop
+    falling back to the slow query. Rebuilding also trims old entries.
+    """
+
+    users = db.session.query(User.id)
+    if not rebuild_all:
+        users = users.filter(User.timeline_ready.is_(False))
+
+    user_ids = [user_id for (user_id,) in users]
+
+    # commit in batches so a big rebuild isn't one huge transaction
+    for count, user_id in enumerate(user_ids, 1):
+        TimelineEntry.rebuild(User.query.get(user_id))
+        if count % 500 == 0:
+            db.session.commit()
+
+    db.session.commit()
+    click.echo(f"Rebuilt {len(user_ids)} timelines.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute users' message/follow/like counters from the real rows.
+
+    Run after adding the counter columns to an existing database, or
+    whenever the stats bar looks wrong.
+    """
+
+    fixed = User.reconcile_counts()
+    db.session.commit()
+    click.echo(f"Fixed counters for {fixed} users.")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static files into static/dist.
+
+    Run as part of each deploy; restart the app afterwards so it links to
+    the new files.
+    """
+
+    manifest = build_static_assets(app.static_folder)
+    compressed = sum(1 for encodings in manifest['encodings'].values()
+                     if encodings)
+    click.echo(f"Built {len(manifest['files'])} assets "
+               f"({compressed} precompressed).")
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Bring an existing database's schema up to date with models.py.
+
+    Safe to run on a live database, and to run again: indexes are built
+    without blocking writes, and finished migrations are skipped.
+    """
+
+    applied = migrations.upgrade(db.engine, echo=click.echo)
+    click.echo(f"Applied {len(applied)} migrations."
+               if applied else "Schema is already up to date.")
+
+
+##############################################################################
+# Cache policy
 #
+# With NO_HTTP_CACHE, nothing is cached at all, as in development:
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+def add_cache_headers(response):
+    """Say how long browsers and proxies may keep this response."""
+
+    if app.config['NO_HTTP_CACHE']:
+        response.headers["Cache-Control"] = (
+            "no-cache, no-store, must-revalidate")
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+        return response
+
+    if request.method not in ('GET', 'HEAD'):
+        return response
+
+    if request.endpoint == 'assets':
+        # a changed file gets a new name, so this one never changes
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+    if request.endpoint == 'static':
+        response.cache_control.public = True
+        if 'v' in request.args:
+            # static_url() changes the URL whenever the file changes
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        return response
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    # pages can change at any moment, so caches must always check back
+    response.cache_control.no_cache = True
 
+    etag = g.get('etag')
+    if etag:
+        response.set_etag(etag)
+        if g.user:
+            response.cache_control.private = True
+        else:
+            # the same for every anonymous visitor, so proxies can share it
+            response.cache_control.public = True
 
+    else:
+        response.cache_control.private = True
+        # personalized pages: still spare the bandwidth of resending one
+        # the browser already has
+        if response.status_code == 200 and not response.direct_passthrough:
+            response.add_etag()
+            response.make_conditional(request)
+
+    return response
@@ -0,0 +1,198 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+`flask build-assets` copies everything in static/ into static/dist/ under
+names that include a hash of the content (style.css becomes eg
+style.3f2a9c1b04de.css), so each version of a file has its own URL and
+browsers can cache it forever. Text files also get gzip copies (style.css.gz)
+and, if the optional `brotli` package is installed, brotli ones (.br). The
+url()s in stylesheets are rewritten to point at the fingerprinted files.
+static/dist/manifest.json records what was built.
+
+The app serves the built files at /assets/, picking the smallest encoding
+the browser accepts. The static_url() template helper links to them, and
+falls back to plain /static/ URLs when nothing has been built.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# worth compressing; images and fonts are compressed already
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+# url("/static/...") or url(../images/...) in a stylesheet
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def fingerprinted(name, content):
+    """`name` with a hash of `content` before its extension."""
+
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha1(content).hexdigest()[:12]}{ext}"
+
+
+def rewrite_css_urls(css, name, files, url_prefix):
+    """Point the url()s in stylesheet `name` at their built files."""
+
+    def replace(match):
+        quote, url = match.groups()
+
+        if url.startswith('/static/'):
+            target = url[len('/static/'):]
+        elif '://' in url or url.startswith(('/', 'data:')):
+            return match.group(0)
+        else:
+            target = os.path.normpath(
+                os.path.join(os.path.dirname(name), url)).replace(os.sep, '/')
+
+        if target not in files:
+            return match.group(0)
+        return f"url({quote}{url_prefix}{files[target]}{quote})"
+
+    return CSS_URL.sub(replace, css)
+
+
+def compress(path):
+    """Write compressed copies of the file at `path`; return the encodings
+    that came out smaller."""
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    variants = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        variants.insert(0, ('br', '.br', brotli.compress))
+
+    encodings = []
+    for encoding, suffix, compressor in variants:
+        compressed = compressor(content)
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            encodings.append(encoding)
+
+    return encodings
+
+
+def build(static_folder, url_prefix='/assets/'):
+    """Build static_folder/dist from static_folder; return the manifest."""
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.exists(dist):
+        shutil.rmtree(dist)
+
+    sources = []
+    for root, dirs, names in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.join(root, d) != dist)
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            sources.append(
+                os.path.relpath(path, static_folder).replace(os.sep, '/'))
+
+    # stylesheets last, so what they refer to already has its final name
+    sources.sort(key=lambda name: (name.endswith('.css'), name))
+
+    files = {}
+    encodings = {}
+
+    for name in sources:
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            content = f.read()
+
+        if name.endswith('.css'):
+            content = rewrite_css_urls(content.decode('utf-8'), name, files,
+                                       url_prefix).encode('utf-8')
+
+        built = fingerprinted(name, content)
+        path = os.path.join(dist, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        files[name] = built
+        if os.path.splitext(name)[1] in TEXT_EXTENSIONS:
+            encodings[built] = compress(path)
+
+    manifest = {'files': files, 'encodings': encodings}
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """Serve built assets, and find the built name for a static file."""
+
+    def __init__(self):
+        self.directory = None
+        self.files = {}
+        self.encodings = {}
+        self.version = None
+
+    def init_app(self, app):
+        """Load `app`'s built assets, if any, and serve them at /assets/."""
+
+        self.load(os.path.join(app.static_folder, DIST_DIR))
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+
+    def load(self, directory):
+        """Use the assets built into `directory`."""
+
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+
+        self.files = manifest.get('files', {})
+        self.encodings = manifest.get('encodings', {})
+
+        # pages link to these names, so cached pages go stale with them
+        self.version = hashlib.sha1(
+            json.dumps(self.files, sort_keys=True).encode()).hexdigest()
+
+    def built_name(self, filename):
+        """Name of the built copy of static file `filename`, if there is one."""
+
+        return self.files.get(filename)
+
+    def send(self, filename):
+        """Serve built file `filename`, compressed if the client allows."""
+
+        if not self.directory:
+            raise NotFound()
+
+        accepted = request.accept_encodings
+        for encoding in self.encodings.get(filename, ()):
+            if accepted[encoding]:
+                suffix = '.br' if encoding == 'br' else '.gz'
+                response = send_from_directory(
+                    self.directory, filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0])
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(self.directory, filename)
+
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+assets = Assets()
@@ -0,0 +1 @@
+"""Benchmarks for Warbler. Run the modules from the project root."""
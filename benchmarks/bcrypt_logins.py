@@ -0,0 +1,71 @@
+"""Benchmark password checks, in logins/sec per core.
+
+Run from the project root, eg:
+
+    python -m benchmarks.bcrypt_logins --rounds 12 --seconds 5
+
+Measures one hashing worker alone, then one worker per core, using the
+same PasswordHasher pool the app uses for logins.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from passwords import PasswordHasher
+
+PASSWORD = "benchmark-password"
+
+
+def logins_per_second(hasher, hashed, clients, seconds):
+    """Check `hashed` from `clients` threads for `seconds`; return rate."""
+
+    done = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            hasher.check(hashed, PASSWORD)
+            with lock:
+                done[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.monotonic()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return done[0] / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="bcrypt work factor (default 12)")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="how long to run each measurement (default 5)")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+
+    # clients wait for room in the pool rather than getting "busy"
+    hasher = PasswordHasher(rounds=args.rounds, workers=1, queue=1, wait=None)
+    hashed = hasher.hash(PASSWORD)
+
+    single = logins_per_second(hasher, hashed, 2, args.seconds)
+
+    hasher.configure(args.rounds, workers=cores, queue=cores, wait=None)
+    total = logins_per_second(hasher, hashed, cores * 2, args.seconds)
+
+    print(f"bcrypt rounds:            {args.rounds}")
+    print(f"one worker:               {single:8.1f} logins/sec")
+    print(f"{cores:2} workers ({cores} cores):  {total:8.1f} logins/sec")
+    print(f"per core:                 {total / cores:8.1f} logins/sec")
+
+
+if __name__ == '__main__':
+    main()
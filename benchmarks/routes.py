@@ -0,0 +1,304 @@
+"""Benchmark Warbler's busiest routes at several data sizes.
+
+Run from the project root against a scratch database (it is dropped and
+reloaded for every tier), eg:
+
+    createdb warbler-bench
+    python -m benchmarks.routes --tiers small,medium --output before.json
+    python -m benchmarks.routes --tiers small,medium --compare before.json
+
+For each tier, generates CSVs with generator/create_csvs.py (kept between
+runs, since the same --seed always gives the same files), loads them with
+seed.py, then sends requests through Flask's test client as one busy user.
+Reports p50/p95/p99 latency, requests/sec and SQL statements per request
+for each route, and writes the lot as JSON so runs on different commits
+can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# rows per table for each tier
+TIERS = {
+    'small': dict(users=1000, messages=10000, follows=20000, likes=10000),
+    'medium': dict(users=10000, messages=100000, follows=200000,
+                   likes=100000),
+    'large': dict(users=100000, messages=1000000, follows=2000000,
+                  likes=1000000),
+}
+
+# run in this order: the writes go last so they can't skew the reads
+ROUTES = ['homepage', 'users_show', 'list_users', 'show_likes', 'like_user',
+          'messages_add']
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def commit_id():
+    """The commit being benchmarked, marked if the tree has changes."""
+
+    def git(*args):
+        return subprocess.run(('git',) + args, cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+
+    commit = git('rev-parse', 'HEAD') or None
+    if commit and git('status', '--porcelain', '--untracked-files=no'):
+        commit += '-dirty'
+    return commit
+
+
+def prepare_data(tier, data_dir, seed, database):
+    """Generate (if needed) and load the CSVs for `tier`."""
+
+    sizes = TIERS[tier]
+    out_dir = os.path.join(data_dir, f"{tier}-seed{seed}")
+
+    if not os.path.exists(os.path.join(out_dir, 'likes.csv')):
+        print(f"[{tier}] generating CSVs in {out_dir}", file=sys.stderr)
+        subprocess.run(
+            [sys.executable, os.path.join('generator', 'create_csvs.py'),
+             '--seed', str(seed), '--out-dir', out_dir]
+            + [arg for table, rows in sizes.items()
+               for arg in (f'--{table}', str(rows))],
+            cwd=ROOT, check=True)
+
+    print(f"[{tier}] loading into {database}", file=sys.stderr)
+    subprocess.run(
+        [sys.executable, 'seed.py', '--data-dir', out_dir,
+         '--batch-size', '50000'],
+        cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+        env=dict(os.environ, DATABASE_URL=database))
+
+
+class Benchmark:
+    """Time requests to each route as one logged-in user."""
+
+    def __init__(self, app, requests, warmup):
+        from sqlalchemy import event
+        from models import db
+
+        self.app = app
+        self.requests = requests
+        self.warmup = warmup
+        self.statements = 0
+
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.statements += 1
+
+    def pick_subjects(self):
+        """Choose who the requests are about.
+
+        The viewer is the user following the most accounts (the costliest
+        home timeline), and the profile shown is the most followed user's.
+        """
+
+        from models import db, User, Message, TimelineEntry
+
+        viewer = User.query.order_by(User.following_count.desc(),
+                                     User.id).first()
+        celebrity = User.query.order_by(User.followers_count.desc(),
+                                        User.id).first()
+
+        # as `flask rebuild-timelines` would, so the home page reads the inbox
+        TimelineEntry.rebuild(viewer)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.celebrity_id = celebrity.id
+        self.search = viewer.username[:2]
+        self.like_ids = [
+            msg_id for (msg_id,) in (db.session
+                                     .query(Message.id)
+                                     .filter(Message.user_id != viewer.id)
+                                     .order_by(Message.id.desc())
+                                     .limit(50))]
+
+        db.session.remove()
+
+    def request(self, client, route, i):
+        """Make the `i`th request to `route`."""
+
+        if route == 'homepage':
+            return client.get('/')
+        if route == 'users_show':
+            return client.get(f'/users/{self.celebrity_id}')
+        if route == 'list_users':
+            return client.get(f'/users?q={self.search}')
+        if route == 'show_likes':
+            return client.get(f'/users/{self.viewer_id}/likes')
+        if route == 'like_user':
+            # each message is liked then unliked, leaving the data as it was
+            msg_id = self.like_ids[(i // 2) % len(self.like_ids)]
+            return client.post(f'/messages/{msg_id}/like')
+        if route == 'messages_add':
+            return client.post('/messages/new',
+                               data={'text': f"Benchmark message {i}"})
+        raise ValueError(route)
+
+    def run(self, route):
+        """Time `route`; return its latency/throughput/statements summary."""
+
+        from app import CURR_USER_KEY
+
+        latencies = []
+        statements = []
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.viewer_id
+
+            for i in range(self.warmup + self.requests):
+                before = self.statements
+                start = time.perf_counter()
+                response = self.request(client, route, i)
+                elapsed = time.perf_counter() - start
+
+                if response.status_code >= 400:
+                    raise RuntimeError(
+                        f"{route} returned {response.status_code}")
+
+                if i >= self.warmup:
+                    latencies.append(elapsed)
+                    statements.append(self.statements - before)
+
+        latencies.sort()
+        result = {
+            f'p{pct}_ms': round(percentile(latencies, pct) * 1000, 3)
+            for pct in PERCENTILES
+        }
+        result['requests_per_sec'] = round(len(latencies) / sum(latencies), 1)
+        result['sql_statements_mean'] = round(
+            sum(statements) / len(statements), 2)
+        result['sql_statements_max'] = max(statements)
+        result['requests'] = len(latencies)
+        return result
+
+
+def print_results(results, baseline=None):
+    """Print a table of `results`, with % changes against `baseline`."""
+
+    header = (f"{'tier':8} {'route':14} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'p99 ms':>9} {'req/s':>8} {'SQL':>6}")
+    if baseline:
+        header += f" {'p50 chg':>8} {'p95 chg':>8}"
+    print(header)
+
+    for tier, tier_results in results['tiers'].items():
+        for route, stats in tier_results['routes'].items():
+            line = (f"{tier:8} {route:14} {stats['p50_ms']:9.2f} "
+                    f"{stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} "
+                    f"{stats['requests_per_sec']:8.1f} "
+                    f"{stats['sql_statements_mean']:6.1f}")
+
+            old = (baseline or {}).get('tiers', {}).get(tier, {}) \
+                .get('routes', {}).get(route)
+            if old:
+                for key in ('p50_ms', 'p95_ms'):
+                    change = (stats[key] - old[key]) / old[key] * 100
+                    line += f" {change:+7.1f}%"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiers', default='small,medium',
+                        help=f"comma separated, from {', '.join(TIERS)} "
+                             f"(default small,medium)")
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help="comma separated routes to time (default all)")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="timed requests per route (default 200)")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="untimed requests per route first (default 20)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="generator seed (default 0)")
+    parser.add_argument('--database', default='postgresql:///warbler-bench',
+                        help="scratch database; its tables are dropped! "
+                             "(default postgresql:///warbler-bench)")
+    parser.add_argument('--data-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'warbler-bench'),
+                        help="where generated CSVs are kept between runs")
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="benchmark what's already loaded (one tier)")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--compare', help="JSON results to compare against")
+    args = parser.parse_args()
+
+    tiers = args.tiers.split(',')
+    routes = args.routes.split(',')
+    for name, valid in (('tier', TIERS), ('route', ROUTES)):
+        unknown = set(tiers if name == 'tier' else routes) - set(valid)
+        if unknown:
+            parser.error(f"unknown {name}: {', '.join(sorted(unknown))}")
+    if args.skip_seed and len(tiers) != 1:
+        parser.error("--skip-seed needs exactly one tier")
+
+    # the app reads its database from the environment when imported
+    os.environ['DATABASE_URL'] = args.database
+    sys.path.insert(0, ROOT)
+    from app import app, fragment_cache, user_cache
+    from models import db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    bench = Benchmark(app, args.requests, args.warmup)
+    results = {
+        'commit': commit_id(),
+        'started': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': {'requests': args.requests, 'warmup': args.warmup,
+                     'seed': args.seed},
+        'tiers': {},
+    }
+
+    for tier in tiers:
+        if not args.skip_seed:
+            db.session.remove()
+            db.engine.dispose()
+            prepare_data(tier, args.data_dir, args.seed, args.database)
+
+        # ids are reused between tiers, so nothing cached can carry over
+        user_cache.clear()
+        fragment_cache.clear()
+        bench.pick_subjects()
+
+        tier_results = results['tiers'][tier] = {'rows': TIERS[tier],
+                                                 'routes': {}}
+        for route in routes:
+            print(f"[{tier}] timing {route}", file=sys.stderr)
+            tier_results['routes'][route] = bench.run(route)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Small in-process caches for Warbler."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe mapping with a size cap and optional expiry.
+
+    Holds at most `maxsize` entries, evicting the least recently used. If
+    `ttl` is given, entries are dropped `ttl` seconds after being set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        if self.maxsize <= 0:
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Forget `keys`, if present."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Forget every entry for which `predicate(key, value)` is true.
+
+        This looks at every entry, so keep it for rare events.
+        """
+
+        with self._lock:
+            doomed = [key for key, (value, expires) in self._entries.items()
+                      if predicate(key, value)]
+            for key in doomed:
+                del self._entries[key]
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
@@ -1,7 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField, ValidationError
 from wtforms.validators import DataRequired, Email, Length
-from models import User
 from app import g
 
 class MessageForm(FlaskForm):
@@ -24,7 +23,7 @@ class UserEditForm(FlaskForm):
 
     def validate_password(form, field):
         """ Validate password """
-        if not User.authenticate(g.user.username, field.data):
+        if not g.user.check_password(field.data):
             raise ValidationError("Invalid Password") # Prints error twice, but why?
 
     username = StringField('Username', validators=[DataRequired()])
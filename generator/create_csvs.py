@@ -2,29 +2,55 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, eg for benchmark data:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 10000000 --likes 10000000 --out-dir /data/warbler-1m
+
+It runs offline, and the same --seed gives the same files whatever the
+number of --workers. Rows are produced in fixed-size chunks spread over a
+process pool and streamed to disk in order, so memory use doesn't grow
+with the data.
+
+Who gets followed (and which messages get liked) follows a power law, so a
+few accounts are very popular and most have a handful of followers. Edges
+are sampled per follower, so only that follower's picks are kept in memory
+to avoid duplicates.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, mix, power_law_rank, scramble
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'created_at']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Rows per unit of work; also what seeds are derived from, so changing it
+# changes the output
+CHUNK_SIZE = 20000
+
+# Messages are dated within the two years before this, so runs repeat
+END_DATE = datetime(2020, 1, 1)
+
+# Everyone shares this password hash (the password is "password")
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +58,198 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs for users (saved from splashbase, so no network needed)
+
+HEADER_IMAGE_IDS = [
+    'mnh0n9pHJW', 'mnh0uemhCk', 'mnh121HEWa', 'mnh17lfd9R', 'mnh1d7s3UD',
+    'mnh1jdFvHR', 'mnh1uhYnog', 'mnh25vNOvI', 'mnh29fxz11', 'mnh2m1hnS8',
+    'mo1h6tGOZf', 'mo2wz2LTCs', 'mo2x3aAnRH', 'mo2x80NkDu', 'mo2x9xqeef',
+    'mo2xbk8JUK', 'mo2xdqmle5', 'mo2xfarCvW', 'mo2xgqdEFn', 'mo2xijE2nr',
+    'mopq4kHmAg', 'mopq69jlcS', 'mopq8fyQwI', 'mopqamedKu', 'mopqc3ZZcz',
+    'mopqdfx05t', 'mopqfpSTPN', 'mopqhxFulr', 'mopqj9QUeq', 'mopqkkwK2M',
+    'mp6rzyNlAN', 'mp6s1hAudo', 'mp6s32zb6l', 'mp6s4dzqHA', 'mp6s661UgK',
+    'mp6s7lR1lS', 'mp6s995bvI', 'mp6sasSvPZ', 'mp6scv2xrZ', 'mpp6f50W26',
+    'mpp6gwrYvm', 'mpp6l06zXi', 'mpp6poZxE5', 'mpp6tjdFhf', 'mpp6w0dxAm'
+]
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{image_id}1st5lhmo1_1280.jpg"
+    for image_id in HEADER_IMAGE_IDS
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+TABLES = {
+    'users': USERS_CSV_HEADERS,
+    'messages': MESSAGES_CSV_HEADERS,
+    'follows': FOLLOWS_CSV_HEADERS,
+    'likes': LIKES_CSV_HEADERS,
+}
+
+fake = Faker()
+
+
+def message_author(seed, message_id, num_users):
+    """Who wrote message `message_id`.
+
+    Worked out from the ids rather than remembered, so generating likes
+    can skip people's own messages without holding every message.
+    """
+
+    return mix(seed, message_id) % num_users + 1
+
+
+def edge_counts(total, num_sources):
+    """How many edges each source (1..num_sources) should start, adding
+    up to `total`.
+
+    Spread evenly, since it's the targets that follow a power law.
+    """
+
+    base, extra = divmod(total, num_sources)
+    return lambda source: base + (1 if source <= extra else 0)
+
+
+def sample_targets(rng, count, num_targets, exponent, allowed):
+    """Pick up to `count` distinct targets from 1..num_targets by power law,
+    keeping only those where `allowed(target)` is true.
+
+    Gives up after a bounded number of draws, so it can come up a little
+    short when `count` is close to `num_targets`.
+    """
+
+    picked = set()
+
+    for _ in range(count * 20 + 100):
+        if len(picked) >= count:
+            break
+
+        target = scramble(power_law_rank(rng, num_targets, exponent),
+                          num_targets)
+        if allowed(target):
+            picked.add(target)
+
+    return picked
+
+
+def users_rows(rng, start, stop, args):
+    for i in range(start, stop):
+        username = f"{fake.user_name()}{i}"
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def messages_rows(rng, start, stop, args):
+    for message_id in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng=rng, now=END_DATE),
+            message_author(args.seed, message_id, args.users),
+        ]
+
+
+def follows_rows(rng, start, stop, args):
+    following = edge_counts(args.follows, args.users)
+
+    for follower in range(start, stop):
+        followed = sample_targets(rng, following(follower), args.users,
+                                  args.exponent,
+                                  lambda user_id: user_id != follower)
+        for followed_user in sorted(followed):
+            yield [followed_user, follower]
+
+
+def likes_rows(rng, start, stop, args):
+    liking = edge_counts(args.likes, args.users)
+
+    def not_own(user_id):
+        return lambda message_id: (
+            message_author(args.seed, message_id, args.users) != user_id)
+
+    for user_id in range(start, stop):
+        liked = sample_targets(rng, liking(user_id), args.messages,
+                               args.exponent, not_own(user_id))
+        for message_id in sorted(liked):
+            yield [user_id, message_id,
+                   get_random_datetime(rng=rng, now=END_DATE)]
+
+
+ROW_MAKERS = {
+    'users': users_rows,
+    'messages': messages_rows,
+    'follows': follows_rows,
+    'likes': likes_rows,
+}
+
+
+def make_chunk(task):
+    """Generate one chunk of a table as CSV text (runs in a worker)."""
+
+    table, chunk, start, stop, args = task
+
+    seed = mix(args.seed, list(TABLES).index(table), chunk)
+    rng = Random(seed)
+    fake.seed_instance(seed)
+
+    out = io.StringIO()
+    csv.writer(out).writerows(ROW_MAKERS[table](rng, start, stop, args))
+    return out.getvalue()
+
+
+def chunks(table, size, args):
+    """Tasks covering ids 1..size of `table` in CHUNK_SIZE pieces."""
+
+    for chunk, start in enumerate(range(1, size + 1, CHUNK_SIZE)):
+        yield table, chunk, start, min(start + CHUNK_SIZE, size + 1), args
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random Warbler data.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=0,
+                        help="likes to generate (default 0: no likes.csv)")
+    parser.add_argument('--exponent', type=float, default=1.1,
+                        help="power law exponent for popularity "
+                             "(higher: more lopsided; default 1.1)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes to use (default: one per core)")
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
+
+    sizes = {
+        'users': args.users,
+        'messages': args.messages,
+        # follows and likes are generated per user
+        'follows': args.users if args.follows else 0,
+        'likes': args.users if args.likes else 0,
+    }
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with Pool(args.workers) as pool:
+        for table, headers in TABLES.items():
+            if not sizes[table]:
+                continue
+
+            path = os.path.join(args.out_dir, f"{table}.csv")
+            with open(path, 'w', newline='') as csv_file:
+                csv.writer(csv_file).writerow(headers)
+
+                for text in pool.imap(make_chunk,
+                                      chunks(table, sizes[table], args)):
+                    csv_file.write(text)
+
+            print(f"Wrote {path}")
+
+
+if __name__ == '__main__':
+    main()
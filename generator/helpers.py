@@ -1,14 +1,59 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
+    Pass your own `rng` (a random.Random) and `now` for repeatable output.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def power_law_rank(rng, n, exponent):
+    """Pick a rank from 1..n, where rank r comes up roughly in proportion
+    to r ** -exponent (so rank 1 is by far the most common).
+
+    Uses inverse transform sampling of the continuous distribution, so it
+    needs no table of weights however large n is.
+    """
+
+    u = rng.random()
+
+    if exponent == 1:
+        rank = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        rank = (((n + 1) ** a - 1) * u + 1) ** (1 / a)
+
+    return min(int(rank), n)
+
+
+def scramble(rank, n, stride=2654435761):
+    """Map rank 1..n onto id 1..n, spreading the low ranks around.
+
+    Multiplying by a stride coprime with n is a bijection mod n, so every
+    id is used exactly once and no lookup table is needed.
+    """
+
+    return (rank - 1) * stride % n + 1
+
+
+def mix(*values):
+    """A well-spread 64 bit hash of some integers (splitmix64)."""
+
+    x = 0
+    for value in values:
+        x = (x + value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 31
+
+    return x
@@ -0,0 +1,273 @@
+"""A small job queue for work that needn't finish before the response.
+
+Routes call `jobs.enqueue('task_name', key=..., **args)` for follow-up
+work such as delivering a new message to followers' timelines. The job is
+a row in the jobs table, written in the request's own transaction, so it
+is queued if and only if the request's changes are committed.
+
+Worker threads in a separate `flask run-jobs` process (never the web
+processes) claim due jobs and run them:
+
+- at least once: a claimed job is marked running and leased for
+  JOB_LEASE_SECONDS, and if its worker dies before finishing, another
+  claims it after that. Tasks must therefore be safe to run twice.
+- with retries: a job that raises is tried again after JOB_RETRY_SECONDS,
+  doubling each time, up to JOB_MAX_ATTEMPTS tries; after that it's left
+  in the table marked failed.
+- once per key: enqueueing with the key of a job that's still pending
+  does nothing, so repeated requests don't pile up duplicate work. A job
+  that's already running doesn't count, so changes made while it runs
+  still get a job of their own.
+
+With JOB_QUEUE off (the default) there is no queue: enqueue() runs the
+task straight away, inside the request, as if it had never been deferred.
+Work too slow for that (`background=True`) goes to a thread in the web
+process instead, once the request's transaction commits; it isn't retried,
+and is lost if the process stops first.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, exists, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from models import db, Job
+
+job_log = logging.getLogger('warbler.jobs')
+
+
+class JobQueue:
+    """Queue and run jobs, keeping them in the database.
+
+    Settings (read from app config by `init_app`):
+
+    - JOB_QUEUE: queue jobs (otherwise enqueue() runs them at once)
+    - JOB_POLL_SECONDS: how often idle workers look for due jobs
+    - JOB_LEASE_SECONDS: how long a job may run before it's retried
+    - JOB_RETRY_SECONDS: wait before the first retry; doubles each time
+    - JOB_MAX_ATTEMPTS: tries before a job is marked failed
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.app = None
+        self.queued = False
+        self.poll_seconds = 1
+        self.lease_seconds = 300
+        self.retry_seconds = 5
+        self.max_attempts = 5
+        self._threads = []
+        self._stopping = threading.Event()
+        # runs background tasks one at a time while the queue is off
+        self._background = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='jobs')
+
+    def init_app(self, app):
+        """Configure from `app`'s settings."""
+
+        self.app = app
+        self.queued = app.config.get('JOB_QUEUE', False)
+        self.poll_seconds = app.config.get('JOB_POLL_SECONDS', 1)
+        self.lease_seconds = app.config.get('JOB_LEASE_SECONDS', 300)
+        self.retry_seconds = app.config.get('JOB_RETRY_SECONDS', 5)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', 5)
+
+    def task(self, fn):
+        """Register `fn` as a task, under its own name."""
+
+        self.tasks[fn.__name__] = fn
+        return fn
+
+    def enqueue(self, task, key=None, delay=0, background=False, **args):
+        """Run task `task` with keyword `args` later, once the current
+        transaction commits and at least `delay` seconds have passed.
+
+        Does nothing if a pending job already has `key`. With the queue off
+        the task runs now, or with `background` on this process's
+        background thread after the commit.
+        """
+
+        if not self.queued:
+            if background:
+                db.session().info.setdefault('background_tasks', []).append(
+                    (task, args))
+            else:
+                self.tasks[task](**args)
+            return
+
+        values = {'task': task, 'args': args, 'key': key,
+                  'run_at': datetime.utcnow() + timedelta(seconds=delay)}
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            insert = (postgresql.insert(Job.__table__)
+                      .values(**values)
+                      .on_conflict_do_nothing(
+                          index_elements=['key'],
+                          index_where=Job.status == 'pending'))
+        else:
+            if key is not None and self.pending(key):
+                return
+            insert = Job.__table__.insert().values(**values)
+
+        db.session.execute(insert)
+
+    @staticmethod
+    def pending(key):
+        """Is a job with `key` waiting to run?"""
+
+        return db.session.query(exists().where(
+            (Job.key == key) & (Job.status == 'pending'))).scalar()
+
+    def claim(self):
+        """Lease the next due job to this worker.
+
+        Returns its (id, task, args), or None if no job is due.
+        """
+
+        now = datetime.utcnow()
+
+        # a running job whose lease ran out lost its worker
+        job = (Job.query
+               .filter(Job.status.in_(('pending', 'running')),
+                       Job.run_at <= now,
+                       or_(Job.locked_until.is_(None),
+                           Job.locked_until < now))
+               .order_by(Job.run_at)
+               .with_for_update(skip_locked=True)
+               .first())
+
+        if job is None:
+            db.session.commit()
+            return None
+
+        claimed = job.id, job.task, job.args
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_until = now + timedelta(seconds=self.lease_seconds)
+
+        # releases the row lock; the lease now keeps other workers off it
+        db.session.commit()
+        return claimed
+
+    def run_next(self):
+        """Run the next due job, if any. Returns whether there was one."""
+
+        claimed = self.claim()
+        if claimed is None:
+            return False
+
+        job_id, task, args = claimed
+
+        try:
+            self.tasks[task](**args)
+            # gone in the same transaction as the task's last changes
+            Job.query.filter(Job.id == job_id).delete(
+                synchronize_session=False)
+            db.session.commit()
+
+        except Exception as error:
+            db.session.rollback()
+            self.retry_later(job_id, error)
+
+        return True
+
+    def retry_later(self, job_id, error):
+        """Record that job `job_id` failed, and when to try it again."""
+
+        job = Job.query.get(job_id)
+        job.last_error = f"{type(error).__name__}: {error}"
+        job.locked_until = None
+
+        if job.attempts >= self.max_attempts:
+            job.status = 'failed'
+            job_log.exception("Job %s (%s) failed for good", job_id, job.task)
+        elif job.key is not None and self.pending(job.key):
+            # queued again while it ran; the newer job will do this work
+            db.session.delete(job)
+            job_log.warning("Job %s (%s) failed, leaving it to the pending "
+                            "job with its key: %s",
+                            job_id, job.task, job.last_error)
+        else:
+            job.status = 'pending'
+            delay = self.retry_seconds * 2 ** (job.attempts - 1)
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+            job_log.warning("Job %s (%s) failed, retrying in %ss: %s",
+                            job_id, job.task, delay, job.last_error)
+
+        db.session.commit()
+
+    def run_in_background(self, task, args):
+        """Run `task` on the background thread, in its own transaction."""
+
+        def run():
+            with self.app.app_context():
+                try:
+                    self.tasks[task](**args)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    job_log.exception("Background task %s failed", task)
+
+        return self._background.submit(run)
+
+    def run_pending(self):
+        """Run jobs until none are due. Returns how many ran."""
+
+        count = 0
+        while self.run_next():
+            count += 1
+        return count
+
+    def work(self):
+        """Run jobs as they come due, until stop() is called."""
+
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    ran = self.run_next()
+            except Exception:
+                job_log.exception("Job worker error")
+                ran = False
+
+            if not ran:
+                self._stopping.wait(self.poll_seconds)
+
+    def start(self, workers):
+        """Start `workers` background worker threads."""
+
+        self._stopping.clear()
+        for n in range(workers):
+            thread = threading.Thread(target=self.work, daemon=True,
+                                      name=f'jobs-{n}')
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the worker threads once their current jobs finish."""
+
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+jobs = JobQueue()
+
+
+@event.listens_for(Session, 'after_commit')
+def start_background_tasks(session):
+    """Hand the tasks a transaction deferred to the background thread."""
+
+    for task, args in session.info.pop('background_tasks', ()):
+        jobs.run_in_background(task, args)
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_background_tasks(session):
+    """Tasks deferred by a transaction that rolled back never run."""
+
+    session.info.pop('background_tasks', None)
@@ -0,0 +1,351 @@
+"""Request and SQL instrumentation for Warbler.
+
+When METRICS_ENABLED is set, Flask and SQLAlchemy hooks record, per
+endpoint:
+
+- request latency and count (by status)
+- SQL statements issued and time spent in them
+- how long requests waited to check a connection out of the pool
+
+plus, per database, how many pooled connections are in use, how far past
+its size the pool has overflowed, and how often a request gave up waiting.
+
+These are served in Prometheus' text format at /metrics. Each process keeps
+its own numbers, so scrape every worker (or run one per container). The
+page is only for the scraper, which must send METRICS_TOKEN as a bearer
+token; without METRICS_TOKEN set it refuses everyone. (The client address
+is no help here: behind a reverse proxy on the same host, every request
+looks local.)
+
+Separately, SLOW_QUERY_MS logs any statement slower than that to the
+"warbler.slow_queries" logger, with the endpoint that ran it.
+
+With both off, no hooks are installed and /metrics doesn't exist, so the
+cost is nothing at all.
+"""
+
+import hmac
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event, exc
+
+slow_query_log = logging.getLogger('warbler.slow_queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# SQL run outside a request (CLI commands, startup) is filed under this
+NO_ENDPOINT = '(none)'
+
+def format_labels(names, values, extra=''):
+    """Render Prometheus labels, eg {endpoint="homepage"}."""
+
+    pairs = [
+        '{}="{}"'.format(name, str(value)
+                         .replace('\\', r'\\')
+                         .replace('"', r'\"')
+                         .replace('\n', r'\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    """Render a sample value without losing precision to exponents."""
+
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """A running total, one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for label_values, value in values:
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Counts of observations falling into fixed buckets, plus their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count over the last, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = (
+                    [0] * (len(self.buckets) + 1) + [0.0])
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+
+        for label_values, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                labels = format_labels(self.labels, label_values,
+                                       f'le="{bound}"')
+                yield f'{self.name}_bucket{labels}', total
+
+            labels = format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels}', counts[-1]
+            yield f'{self.name}_count{labels}', total
+
+
+class PoolGauge:
+    """A current reading from each database's connection pool."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, databases):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.databases = databases
+
+    def samples(self):
+        for database, engine in sorted(self.databases.items()):
+            try:
+                value = self.read(engine.pool)
+            except AttributeError:
+                # only QueuePool keeps these numbers
+                continue
+            yield self.name + format_labels(('database',), (database,)), value
+
+
+class Metrics:
+    """Hooks a Flask app and its SQLAlchemy engine up to the metrics below.
+
+    Settings (read from app config by `init_app`):
+
+    - METRICS_ENABLED: record metrics and serve them at /metrics
+    - SLOW_QUERY_MS: log statements slower than this (0 to turn off)
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            'warbler_requests_total',
+            "Requests handled.",
+            ('endpoint', 'method', 'status'))
+        self.request_duration = Histogram(
+            'warbler_request_duration_seconds',
+            "Time to handle a request.",
+            LATENCY_BUCKETS, ('endpoint',))
+        self.request_statements = Histogram(
+            'warbler_request_sql_statements',
+            "SQL statements issued per request.",
+            STATEMENT_BUCKETS, ('endpoint',))
+        self.sql_statements = Counter(
+            'warbler_sql_statements_total',
+            "SQL statements issued.",
+            ('endpoint',))
+        self.sql_duration = Counter(
+            'warbler_sql_duration_seconds_total',
+            "Time spent running SQL statements.",
+            ('endpoint',))
+        self.slow_queries = Counter(
+            'warbler_sql_slow_statements_total',
+            "SQL statements slower than SLOW_QUERY_MS.",
+            ('endpoint',))
+        self.pool_wait = Histogram(
+            'warbler_db_pool_checkout_wait_seconds',
+            "Time spent waiting for a pooled database connection.",
+            WAIT_BUCKETS, ('endpoint',))
+        self.pool_timeouts = Counter(
+            'warbler_db_pool_timeouts_total',
+            "Requests that gave up waiting for a pooled connection.",
+            ('database',))
+
+        # database name -> engine, for the pool gauges
+        self.databases = {}
+        self.pool_checked_out = PoolGauge(
+            'warbler_db_pool_checked_out',
+            "Pooled connections in use.",
+            lambda pool: pool.checkedout(), self.databases)
+        self.pool_size = PoolGauge(
+            'warbler_db_pool_size',
+            "Connections the pool keeps open.",
+            lambda pool: pool.size(), self.databases)
+        self.pool_overflow = PoolGauge(
+            'warbler_db_pool_overflow',
+            "Connections open beyond the pool size (negative: unused "
+            "pool slots).",
+            lambda pool: pool.overflow(), self.databases)
+
+        self.enabled = False
+        self.slow_query_seconds = None
+        self.token = None
+
+    @property
+    def all(self):
+        return (self.requests, self.request_duration,
+                self.request_statements, self.sql_statements,
+                self.sql_duration, self.slow_queries, self.pool_wait,
+                self.pool_timeouts, self.pool_checked_out, self.pool_size,
+                self.pool_overflow)
+
+    def init_app(self, app, engines):
+        """Install the hooks `app`'s settings ask for on `app` and its
+        `engines` (a dict of database name to engine)."""
+
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.token = app.config.get('METRICS_TOKEN') or None
+        slow_query_ms = app.config.get('SLOW_QUERY_MS', 0)
+        self.slow_query_seconds = (slow_query_ms / 1000
+                                   if slow_query_ms else None)
+
+        for database, engine in engines.items():
+            if self.enabled or self.slow_query_seconds is not None:
+                event.listen(engine, 'before_cursor_execute',
+                             self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute',
+                             self._after_cursor_execute)
+
+            if self.enabled:
+                self.databases[database] = engine
+                self._time_pool_checkouts(engine, database)
+                # dispose() swaps in a new pool, which needs timing too
+                event.listen(engine, 'engine_disposed',
+                             lambda engine, database=database:
+                             self._time_pool_checkouts(engine, database))
+
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            app.add_url_rule('/metrics', 'metrics', self.render)
+
+    def render(self):
+        """The /metrics page: everything, in Prometheus' text format."""
+
+        if not self._may_scrape():
+            abort(403)
+
+        lines = []
+        for metric in self.all:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {format_value(value)}'
+                         for name, value in metric.samples())
+
+        return Response('\n'.join(lines) + '\n',
+                        content_type='text/plain; version=0.0.4')
+
+    def _may_scrape(self):
+        """Does this request carry METRICS_TOKEN? Without one set, no
+        request does."""
+
+        if self.token is None:
+            return False
+
+        authorization = request.headers.get('Authorization', '')
+        scheme, _, token = authorization.partition(' ')
+        return (scheme.lower() == 'bearer'
+                and hmac.compare_digest(token.encode(), self.token.encode()))
+
+    def _endpoint(self):
+        if not has_request_context():
+            return NO_ENDPOINT
+        return request.endpoint or '(unmatched)'
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.sql_statements = 0
+
+    def _after_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+
+        endpoint = self._endpoint()
+        self.requests.inc(endpoint, request.method, response.status_code)
+        self.request_duration.observe(time.perf_counter() - start, endpoint)
+        self.request_statements.observe(g.pop('sql_statements', 0), endpoint)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+        endpoint = self._endpoint()
+
+        if self.enabled:
+            self.sql_statements.inc(endpoint)
+            self.sql_duration.inc(endpoint, amount=elapsed)
+            if has_request_context() and 'sql_statements' in g:
+                g.sql_statements += 1
+
+        if (self.slow_query_seconds is not None
+                and elapsed >= self.slow_query_seconds):
+            if self.enabled:
+                self.slow_queries.inc(endpoint)
+            slow_query_log.warning("%.1fms in %s: %s", elapsed * 1000,
+                                   endpoint, statement)
+
+    def _time_pool_checkouts(self, engine, database):
+        """Wrap `engine`'s pool so waits for a connection are recorded."""
+
+        pool = engine.pool
+        do_get = pool._do_get
+
+        def timed_do_get():
+            start = time.perf_counter()
+            try:
+                return do_get()
+            except exc.TimeoutError:
+                self.pool_timeouts.inc(database)
+                raise
+            finally:
+                self.pool_wait.observe(time.perf_counter() - start,
+                                       self._endpoint())
+
+        pool._do_get = timed_do_get
+
+
+metrics = Metrics()
@@ -0,0 +1,323 @@
+"""Versioned schema migrations for existing Warbler databases.
+
+`db.create_all()` only creates missing tables; it never adds columns or
+indexes to tables that already exist. So each change to the schema in
+models.py is also listed here as a numbered migration, and
+
+    flask migrate
+
+applies whichever ones a database hasn't had yet, recording each in the
+schema_migrations table. A database made from scratch by create_all()
+already matches models.py, so every migration is recorded as applied when
+its users table is created.
+
+Migrations run outside a transaction so PostgreSQL can build indexes
+CONCURRENTLY, without blocking the app's writes while they build. Each is
+written to be safe to run again if it's interrupted part way.
+
+To change the schema: edit models.py as usual, then add a migration at the
+end of this file that makes the same change to an existing database.
+"""
+
+import re
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from models import (db, User, Message, Follows, Likes, TimelineEntry, Job,
+                    TrendingMessage, create_username_search_index)
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+)
+
+# (version, name, function to apply it), in order
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register the decorated function as migration number `version`."""
+
+    def register(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version
+        MIGRATIONS.append((version, name, fn))
+        return fn
+
+    return register
+
+
+def applied_versions(connection):
+    """Versions already applied to the database."""
+
+    return {version for (version,) in
+            connection.execute(select([schema_migrations.c.version]))}
+
+
+def upgrade(engine, echo=print):
+    """Apply any migrations the database behind `engine` hasn't had.
+
+    Returns the versions applied.
+    """
+
+    schema_migrations.create(engine, checkfirst=True)
+    applied = []
+
+    with engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+
+        done = applied_versions(connection)
+
+        for version, name, apply in MIGRATIONS:
+            if version in done:
+                continue
+
+            echo(f"Applying migration {version}: {name}")
+            apply(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, name=name))
+            applied.append(version)
+
+    return applied
+
+
+@event.listens_for(db.metadata, 'after_create')
+def stamp_new_schema(target, connection, tables=(), **kw):
+    """A schema made by create_all() needs none of the migrations."""
+
+    if User.__table__ in tables:
+        connection.execute(schema_migrations.insert(), [
+            {'version': version, 'name': name}
+            for version, name, apply in MIGRATIONS
+        ])
+
+
+##############################################################################
+# Building blocks
+
+
+def add_column(connection, column, fill=None):
+    """Add a model's `column` to its table, unless it's already there.
+
+    Rows already in the table get `fill` (an SQL literal) for it, for NOT
+    NULL columns the database has no default for.
+    """
+
+    table = column.table.name
+    existing = {col['name'] for col in inspect(connection).get_columns(table)}
+
+    if column.name not in existing:
+        ddl = str(CreateColumn(column).compile(dialect=connection.dialect))
+        if fill is not None:
+            ddl += f" DEFAULT {fill}"
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+
+    # (SQLite can't drop a default, but only new rows would see it, and
+    # the model always sets the column)
+    if fill is not None and connection.dialect.name == 'postgresql':
+        connection.execute(f"ALTER TABLE {table} "
+                           f"ALTER COLUMN {column.name} DROP DEFAULT")
+
+
+def utc_now_literal():
+    """The time now, in UTC, as an SQL timestamp literal."""
+
+    return datetime.utcnow().strftime("'%Y-%m-%d %H:%M:%S'")
+
+
+def drop_invalid_index(connection, name):
+    """Drop index `name` if an interrupted concurrent build left it invalid.
+
+    Returns whether a usable index by that name exists.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    valid = connection.execute(
+        text("SELECT indisvalid FROM pg_index "
+             "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+             "WHERE relname = :name"),
+        name=name).scalar()
+
+    if valid is False:
+        connection.execute(f"DROP INDEX CONCURRENTLY {name}")
+
+    return bool(valid)
+
+
+def build_index(connection, table, name, ddl):
+    """Run CREATE INDEX statement `ddl` unless index `name` already exists.
+
+    On PostgreSQL the index is built concurrently.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        if drop_invalid_index(connection, name):
+            return
+        ddl = re.sub(r'^CREATE (UNIQUE )?INDEX',
+                     r'CREATE \1INDEX CONCURRENTLY', ddl)
+
+    elif name in {index['name'] for index in
+                  inspect(connection).get_indexes(table)}:
+        return
+
+    connection.execute(ddl)
+
+
+def drop_index(connection, name):
+    """Drop index `name`, if it's there.
+
+    On PostgreSQL the index is dropped concurrently.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    else:
+        connection.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_index(connection, index):
+    """Build a model's `index`, unless it's already there."""
+
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    build_index(connection, index.table.name, index.name, ddl)
+
+
+def model_index(model, name):
+    """The index called `name` declared on `model`."""
+
+    return next(index for index in model.__table__.indexes
+                if index.name == name)
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, "Add stats counters and timeline_ready to users")
+def add_user_counters(connection):
+    for column in ('messages_count', 'following_count', 'followers_count',
+                   'likes_count', 'timeline_ready'):
+        add_column(connection, User.__table__.c[column])
+
+    User.reconcile_counts()
+    db.session.commit()
+
+
+@migration(2, "Add precomputed home timelines")
+def add_timeline_entries(connection):
+    # existing users have timeline_ready false, so homepages fall back to
+    # querying messages until `flask rebuild-timelines` has run
+    TimelineEntry.__table__.create(connection, checkfirst=True)
+
+
+@migration(3, "Allow one like per user per message")
+def add_unique_likes(connection):
+    duplicates = connection.execute(
+        "DELETE FROM likes WHERE id IN ("
+        " SELECT id FROM ("
+        "  SELECT id, row_number() OVER ("
+        "   PARTITION BY user_id, message_id ORDER BY id) AS n"
+        "  FROM likes) AS numbered"
+        " WHERE n > 1)").rowcount
+
+    if duplicates:
+        User.reconcile_counts()
+        db.session.commit()
+
+    name = 'uq_likes_user_message'
+    constraints = {constraint['name'] for constraint in
+                   inspect(connection).get_unique_constraints('likes')}
+    if name in constraints:
+        return
+
+    build_index(connection, 'likes', name,
+                f"CREATE UNIQUE INDEX {name} ON likes (user_id, message_id)")
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(f"ALTER TABLE likes ADD CONSTRAINT {name} "
+                           f"UNIQUE USING INDEX {name}")
+
+
+@migration(4, "Index usernames for search")
+def add_username_search_index(connection):
+    concurrently = connection.dialect.name == 'postgresql'
+    drop_invalid_index(connection, 'ix_users_username_search')
+    create_username_search_index(connection, concurrently=concurrently)
+
+
+@migration(5, "Index messages by author, follows by follower and likes "
+              "by message")
+def add_lookup_indexes(connection):
+    create_index(connection,
+                 model_index(Message, 'ix_messages_user_timestamp'))
+    create_index(connection, model_index(Follows, 'ix_follows_following'))
+    create_index(connection, model_index(Likes, 'ix_likes_message_id'))
+
+
+@migration(6, "Add the job queue")
+def add_jobs(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+
+@migration(7, "Record when likes were made")
+def add_like_times(connection):
+    # likes from before this have no time; they all get the migration's,
+    # and likes pages fall back to id order for them
+    add_column(connection, Likes.__table__.c.created_at,
+               fill=utc_now_literal())
+    create_index(connection, model_index(Likes, 'ix_likes_user_created'))
+
+
+@migration(8, "Add the trending leaderboard")
+def add_trending(connection):
+    # like times are UTC, like every other timestamp
+    if connection.dialect.name == 'postgresql':
+        connection.execute("ALTER TABLE likes ALTER COLUMN created_at "
+                           "SET DEFAULT timezone('utc', now())")
+
+    # starts empty, and fills as messages are liked
+    TrendingMessage.__table__.create(connection, checkfirst=True)
+
+
+@migration(9, "Record which home timelines are complete")
+def add_timeline_complete(connection):
+    # every timeline starts out incomplete, so homepages keep looking past
+    # the end of it until `flask rebuild-timelines --all` has run
+    add_column(connection, User.__table__.c.timeline_complete)
+
+
+@migration(10, "Mark running jobs, so new jobs with their keys can queue")
+def add_running_jobs(connection):
+    # jobs leased to a worker were left pending; they're running now
+    connection.execute("UPDATE jobs SET status = 'running' "
+                       "WHERE status = 'pending' AND locked_until IS NOT NULL")
+
+    create_index(connection, model_index(Job, 'ix_jobs_queued_run_at'))
+    drop_index(connection, 'ix_jobs_pending_run_at')
+
+    # only PostgreSQL had the partial unique index; elsewhere a failed job
+    # held on to its key for good
+    if connection.dialect.name == 'sqlite':
+        drop_index(connection, 'uq_jobs_pending_key')
+        create_index(connection, model_index(Job, 'uq_jobs_pending_key'))
+
+
+@migration(11, "Only take counted likes off trending scores")
+def add_trending_counted_since(connection):
+    # the app times likes itself, in UTC, so the database's default goes
+    if connection.dialect.name == 'postgresql':
+        connection.execute("ALTER TABLE likes ALTER COLUMN created_at "
+                           "DROP DEFAULT")
+
+    # rows already there may be missing older likes, so only likes from
+    # now on count as in their scores
+    add_column(connection, TrendingMessage.__table__.c.counted_since,
+               fill=utc_now_literal())
@@ -1,12 +1,79 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import math
+import random
+import secrets
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import (event, exists, func, literal, or_, select, true,
+                        tuple_, union)
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica when the request picked one.
+
+    The app sets `g.db_replica` to the bind key of a read-only replica for
+    requests that only read (see choose_database in app.py). Flushes
+    always go to the primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = has_request_context() and g.get('db_replica')
+
+        if replica and not self._flushing:
+            return self.db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    """Cap how long this request's statements may run.
+
+    The app sets `g.statement_timeout_ms` per kind of request (see
+    limit_statements in app.py); it lasts until the transaction ends.
+    """
+
+    timeout = has_request_context() and g.get('statement_timeout_ms')
+
+    if timeout and connection.dialect.name == 'postgresql':
+        connection.execute(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# How many of the newest messages a precomputed home timeline keeps;
+# pages older than this are served by querying messages directly
+TIMELINE_LENGTH = 500
+
+# Deliveries trim about this share of their recipients' timelines back to
+# TIMELINE_LENGTH; so timelines run over by ~1/share entries at most,
+# while each delivery only pays for trimming a few of them
+TIMELINE_TRIM_SHARE = 0.05
+
+# Rows deleted per transaction when purging a big account in the background
+PURGE_CHUNK_SIZE = 1000
+
+# A like counts half as much towards trending every TRENDING_HALF_LIFE
+TRENDING_HALF_LIFE = timedelta(hours=6)
+TRENDING_EPOCH = datetime(2020, 1, 1)
 
 
 class Follows(db.Model): #plural class?
@@ -26,6 +93,12 @@ class Follows(db.Model): #plural class?
         primary_key=True,
     )
 
+    # the primary key leads with who's followed; this serves the other way
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model): #plural class?
     """Mapping user likes to warbles."""
@@ -48,6 +121,80 @@ class Likes(db.Model): #plural class?
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    # in UTC, like other timestamps
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # one like per user per message, even if two requests race
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
+        db.Index('ix_likes_message_id', 'message_id'),
+        # a user's likes, newest first, for their likes page
+        db.Index('ix_likes_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+    @classmethod
+    def message_ids_of(cls, user_id):
+        """Set of ids of the messages user `user_id` has liked."""
+
+        return {
+            message_id for (message_id,) in
+            db.session.query(cls.message_id).filter(cls.user_id == user_id)
+        }
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message for this user, or unlike it if already liked.
+
+        Returns (liked, liked_at). liked is True if it's now liked and
+        False if it was unliked, or None if nothing changed: the message is
+        missing, is the user's own, or a concurrent request liked it first.
+        liked_at is when the like that was added or removed was made.
+        """
+
+        postgres = db.session.get_bind().dialect.name == 'postgresql'
+
+        unlike = cls.__table__.delete().where(
+            (cls.user_id == user_id) & (cls.message_id == message_id))
+
+        if postgres:
+            unliked_at = db.session.execute(
+                unlike.returning(cls.created_at)).scalar()
+        else:
+            unliked_at = (db.session.query(cls.created_at)
+                          .filter(cls.user_id == user_id,
+                                  cls.message_id == message_id)
+                          .scalar())
+            if unliked_at and not db.session.execute(unlike).rowcount:
+                unliked_at = None
+
+        if unliked_at is not None:
+            return False, unliked_at
+
+        # the ownership check is part of the insert: own messages select
+        # no rows, so nothing is inserted
+        liked_at = datetime.utcnow()
+        likable = (select([literal(user_id), Message.id,
+                           literal(liked_at, db.DateTime)])
+                   .where(Message.id == message_id)
+                   .where(Message.user_id != user_id))
+        columns = ['user_id', 'message_id', 'created_at']
+
+        if postgres:
+            insert = (postgresql.insert(cls.__table__)
+                      .from_select(columns, likable)
+                      .on_conflict_do_nothing())
+        else:
+            insert = cls.__table__.insert().from_select(columns, likable)
+
+        if db.session.execute(insert).rowcount == 1:
+            return True, liked_at
+        return None, None
+
 
 
 class User(db.Model):
@@ -95,42 +242,397 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # False until the precomputed timeline has been built for this user;
+    # the homepage falls back to querying followed users' messages directly
+    timeline_ready = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # True while the precomputed timeline holds every message it should
+    # (nothing trimmed or left out for length), so the homepage needn't
+    # look past its end for older ones
+    timeline_complete = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Denormalized counts for the stats bar, kept up to date by the routes
+    # that change them; `flask reconcile-counters` repairs any drift
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # deleting a user leaves their rows to the foreign keys' ON DELETE
+    # CASCADE, rather than loading every one to delete it here
+    messages = db.relationship('Message', passive_deletes='all')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
     
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def following_ids(self):
+        """Set of ids of the users this user follows.
+
+        Loaded with one query the first time it's needed and kept until the
+        user is expired (eg by a commit) or `following` is changed.
+        """
+
+        if self._following_ids is None:
+            self._following_ids = {
+                user_id for (user_id,) in
+                db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id)
+            }
+
+        return self._following_ids
+
+    _following_ids = None
+
+    @property
+    def liked_message_ids(self):
+        """Set of ids of the messages this user has liked.
+
+        Cached like `following_ids`, and dropped when `likes` changes.
+        """
+
+        if self._liked_message_ids is None:
+            self._liked_message_ids = Likes.message_ids_of(self.id)
+
+        return self._liked_message_ids
+
+    _liked_message_ids = None
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(exists().where(
+            (Follows.user_being_followed_id == self.id)
+            & (Follows.user_following_id == other_user.id))).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` does this user follow? Returns a set.
+
+        For list pages: answers for every listed user in one query.
+        """
+
+        user_ids = set(user_ids)
+
+        if not user_ids:
+            return set()
+
+        if self._following_ids is not None:
+            return self._following_ids & user_ids
+
+        return {
+            user_id for (user_id,) in
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == self.id,
+                    Follows.user_being_followed_id.in_(user_ids))
+        }
+
+    def liked_among(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set.
+
+        For message lists: answers for every listed message in one query.
+        """
+
+        message_ids = set(message_ids)
+
+        if not message_ids:
+            return set()
+
+        if self._liked_message_ids is not None:
+            return self._liked_message_ids & message_ids
+
+        return {
+            message_id for (message_id,) in
+            db.session.query(Likes.message_id)
+            .filter(Likes.user_id == self.id,
+                    Likes.message_id.in_(message_ids))
+        }
+
+    @classmethod
+    def adjust_count(cls, counter, delta, *criteria):
+        """Add `delta` to `counter` (eg User.likes_count) in the database
+        for every user matching `criteria`."""
+
+        (cls.query
+         .filter(*criteria)
+         .update({counter: counter + delta}, synchronize_session=False))
+
+    def release_counts(self):
+        """Take this user out of everyone else's counters.
+
+        Call before deleting the user: the people they follow lose a
+        follower, their followers follow one fewer user, and anyone who
+        liked their messages loses those likes.
+        """
+
+        User.adjust_count(
+            User.followers_count, -1,
+            User.id.in_(select([Follows.user_being_followed_id])
+                        .where(Follows.user_following_id == self.id)))
+
+        User.adjust_count(
+            User.following_count, -1,
+            User.id.in_(select([Follows.user_following_id])
+                        .where(Follows.user_being_followed_id == self.id)))
+
+        liked_here = (select([func.count(Likes.id)])
+                      .select_from(Likes.__table__.join(Message.__table__))
+                      .where(Message.user_id == self.id)
+                      .where(Likes.user_id == User.id)
+                      .as_scalar())
+
+        User.adjust_count(
+            User.likes_count, -liked_here,
+            User.id.in_(select([Likes.user_id])
+                        .select_from(Likes.__table__.join(Message.__table__))
+                        .where(Message.user_id == self.id)))
+
+    def release_identity(self):
+        """Give up this user's username and email, so others can take them
+        and no one can log in as them while their rows are purged."""
+
+        placeholder = f"deleted-{secrets.token_hex(8)}"
+        self.username = placeholder
+        self.email = f"{placeholder}@deleted.invalid"
+
+    @property
+    def footprint(self):
+        """Roughly how many rows deleting this user would remove."""
+
+        # each message sits in its author's and followers' timelines,
+        # which keep only their newest TIMELINE_LENGTH entries
+        timeline_entries = (min(self.messages_count, TIMELINE_LENGTH)
+                            * (self.followers_count + 1))
+
+        return (self.messages_count + self.followers_count
+                + self.following_count + self.likes_count
+                + timeline_entries + TIMELINE_LENGTH)
+
+    @classmethod
+    def purge_chunk(cls, user_id, chunk_size=PURGE_CHUNK_SIZE):
+        """Delete up to `chunk_size` of a user's follows, likes, timeline
+        entries or messages (or of the likes and timeline entries of their
+        messages), taking them out of other users' counters.
+
+        For deleting a big account a transaction at a time, so no one
+        statement holds locks for long. Returns how many rows went; 0 once
+        only the user row itself (see `release_counts`) is left.
+        """
+
+        def first(column, *criteria):
+            return [value for (value,) in
+                    db.session.query(column).filter(*criteria)
+                    .limit(chunk_size)]
+
+        followed_ids = first(Follows.user_being_followed_id,
+                             Follows.user_following_id == user_id)
+        if followed_ids:
+            cls.adjust_count(cls.followers_count, -1,
+                             cls.id.in_(followed_ids))
+            return (Follows.query
+                    .filter(Follows.user_following_id == user_id,
+                            Follows.user_being_followed_id.in_(followed_ids))
+                    .delete(synchronize_session=False))
+
+        follower_ids = first(Follows.user_following_id,
+                             Follows.user_being_followed_id == user_id)
+        if follower_ids:
+            cls.adjust_count(cls.following_count, -1,
+                             cls.id.in_(follower_ids))
+            return (Follows.query
+                    .filter(Follows.user_being_followed_id == user_id,
+                            Follows.user_following_id.in_(follower_ids))
+                    .delete(synchronize_session=False))
+
+        like_ids = first(Likes.id, Likes.user_id == user_id)
+        if like_ids:
+            return (Likes.query
+                    .filter(Likes.id.in_(like_ids))
+                    .delete(synchronize_session=False))
+
+        entry_ids = first(TimelineEntry.message_id,
+                          TimelineEntry.user_id == user_id)
+        if entry_ids:
+            return (TimelineEntry.query
+                    .filter(TimelineEntry.user_id == user_id,
+                            TimelineEntry.message_id.in_(entry_ids))
+                    .delete(synchronize_session=False))
+
+        # a chunk of messages goes only once the rows that would cascade
+        # with it (their copies in timelines, then their likes) are gone,
+        # so no one delete reaches further than `chunk_size` rows
+        message_ids = first(Message.id, Message.user_id == user_id)
+        if not message_ids:
+            return 0
+
+        entry_keys = (db.session
+                      .query(TimelineEntry.user_id, TimelineEntry.message_id)
+                      .filter(TimelineEntry.message_id.in_(message_ids))
+                      .limit(chunk_size)
+                      .all())
+        if entry_keys:
+            return (TimelineEntry.query
+                    .filter(tuple_(TimelineEntry.user_id,
+                                   TimelineEntry.message_id)
+                            .in_([tuple(key) for key in entry_keys]))
+                    .delete(synchronize_session=False))
+
+        like_ids = first(Likes.id, Likes.message_id.in_(message_ids))
+        if like_ids:
+            liked_here = (select([func.count(Likes.id)])
+                          .where(Likes.id.in_(like_ids))
+                          .where(Likes.user_id == cls.id)
+                          .as_scalar())
+            cls.adjust_count(
+                cls.likes_count, -liked_here,
+                cls.id.in_(select([Likes.user_id])
+                           .where(Likes.id.in_(like_ids))))
+            return (Likes.query
+                    .filter(Likes.id.in_(like_ids))
+                    .delete(synchronize_session=False))
+
+        return (Message.query
+                .filter(Message.id.in_(message_ids))
+                .delete(synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables.
+
+        Only rows that have drifted are written. Returns how many were.
+        """
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # count each table once and join the totals in; correlated
+            # subqueries recount for every user and crawl on big tables
+            actual, counts = cls._grouped_counts()
+            query = cls.query.filter(cls.id == counts.c.id)
+        else:
+            actual = cls._correlated_counts()
+            query = cls.query
+
+        drifted = or_(*[counter != count for counter, count in actual.items()])
+
+        return (query
+                .filter(drifted)
+                .update(actual, synchronize_session=False))
+
+    @classmethod
+    def _correlated_counts(cls):
+        """Each counter's true value, as a subquery run per user."""
+
+        return {
+            cls.messages_count: (select([func.count(Message.id)])
+                                 .where(Message.user_id == cls.id)
+                                 .as_scalar()),
+            cls.following_count: (select([func.count()])
+                                  .select_from(Follows.__table__)
+                                  .where(Follows.user_following_id == cls.id)
+                                  .as_scalar()),
+            cls.followers_count: (select([func.count()])
+                                  .select_from(Follows.__table__)
+                                  .where(Follows.user_being_followed_id
+                                         == cls.id)
+                                  .as_scalar()),
+            cls.likes_count: (select([func.count(Likes.id)])
+                              .where(Likes.user_id == cls.id)
+                              .as_scalar()),
+        }
+
+    @classmethod
+    def _grouped_counts(cls):
+        """Each counter's true value, from one GROUP BY pass per table.
+
+        Returns the counter values and the derived `counts` table they come
+        from; filtering on `counts.c.id` makes the update an UPDATE ... FROM.
+        """
+
+        def per_user(user_col):
+            return (select([user_col.label('user_id'),
+                            func.count().label('n')])
+                    .group_by(user_col)
+                    .alias())
+
+        sources = {
+            cls.messages_count: per_user(Message.user_id),
+            cls.following_count: per_user(Follows.user_following_id),
+            cls.followers_count: per_user(Follows.user_being_followed_id),
+            cls.likes_count: per_user(Likes.user_id),
+        }
+
+        users = cls.__table__.alias('counted')
+        joined = users
+        for source in sources.values():
+            joined = joined.outerjoin(source, source.c.user_id == users.c.id)
+
+        counts = (select([users.c.id] + [
+                      func.coalesce(source.c.n, 0).label(counter.key)
+                      for counter, source in sources.items()])
+                  .select_from(joined)
+                  .alias('counts'))
+
+        return {counter: counts.c[counter.key] for counter in sources}, counts
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -139,13 +641,16 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
             email=email,
             password=hashed_pwd,
             image_url=image_url,
+            # a brand new user follows nobody, so an empty timeline is correct
+            timeline_ready=True,
+            timeline_complete=True,
         )
 
         db.session.add(user)
@@ -160,17 +665,96 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash used an old work factor it is replaced with a
+        fresh one; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash(password)
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Is `password` this user's password?"""
+
+        return hasher.check(self.password, password)
+
+
+@event.listens_for(User, 'expire')
+def forget_cached_ids(target, *args):
+    """Drop a user's cached id sets once their attributes are expired."""
+
+    # expiry can reach users that have already been garbage collected
+    if target is None:
+        return
+
+    target._following_ids = None
+    target._liked_message_ids = None
+
+
+@event.listens_for(User.following, 'append')
+@event.listens_for(User.following, 'remove')
+def forget_following_ids(target, *args):
+    """Drop a user's cached `following_ids` when `following` changes."""
+
+    target._following_ids = None
+
+
+@event.listens_for(User.likes, 'append')
+@event.listens_for(User.likes, 'remove')
+def forget_liked_message_ids(target, *args):
+    """Drop a user's cached `liked_message_ids` when `likes` changes."""
+
+    target._liked_message_ids = None
+
+
+def create_username_search_index(connection, concurrently=False):
+    """Index lower(username) for the user search on /users.
+
+    On PostgreSQL with pg_trgm available this is a trigram index, which
+    serves both prefix and substring matches. Otherwise it is a plain
+    index that serves prefix matches only; substring matches scan, capped
+    by the page size.
+
+    With `concurrently`, PostgreSQL builds it without blocking writes; that
+    needs a connection outside any transaction.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        create = ("CREATE INDEX CONCURRENTLY IF NOT EXISTS"
+                  if concurrently else "CREATE INDEX IF NOT EXISTS")
+
+        has_trgm = connection.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        ).scalar()
+
+        if has_trgm:
+            connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            connection.execute(
+                f"{create} ix_users_username_search "
+                "ON users USING gin (lower(username) gin_trgm_ops)")
+        else:
+            connection.execute(
+                f"{create} ix_users_username_search "
+                "ON users (lower(username) text_pattern_ops)")
+
+    else:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_users_username_search "
+            "ON users (lower(username))")
+
+
+@event.listens_for(User.__table__, 'after_create')
+def add_username_search_index(target, connection, **kw):
+    """Create the username search index along with the users table."""
+
+    create_username_search_index(connection)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -190,7 +774,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -201,6 +785,437 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # a user's messages, newest first, read straight off the index
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's precomputed home timeline.
+
+    Messages are fanned out to the author and their followers when posted,
+    so the homepage only has to read the newest entries for one user.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so the timeline can be read off this index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    @classmethod
+    def deliver(cls, message, recipients):
+        """Add `message` to the timelines of the users `recipients` selects
+        (a select of user ids labelled user_id).
+
+        The message must already be flushed so that it has an id. Anyone
+        who already has it is skipped, so delivering again is harmless.
+        """
+
+        recipients = recipients.alias('recipients')
+        rows = select([
+            recipients.c.user_id,
+            literal(message.id),
+            literal(message.timestamp, db.DateTime),
+        ])
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            insert = (postgresql.insert(cls.__table__)
+                      .from_select(['user_id', 'message_id', 'timestamp'],
+                                   rows)
+                      .on_conflict_do_nothing())
+        else:
+            already_there = (select([cls.user_id])
+                             .where(cls.message_id == message.id))
+            insert = cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                rows.where(~recipients.c.user_id.in_(already_there)))
+
+        db.session.execute(insert)
+        cls.trim(recipients, share=TIMELINE_TRIM_SHARE)
+
+    @classmethod
+    def fan_out(cls, message):
+        """Deliver `message` to its author and everyone following them."""
+
+        cls.deliver(message, union(
+            select([Follows.user_following_id.label('user_id')])
+            .where(Follows.user_being_followed_id == message.user_id),
+            select([literal(message.user_id).label('user_id')]),
+        ))
+
+    @classmethod
+    def trim(cls, recipients, share=1):
+        """Drop entries past the newest TIMELINE_LENGTH from the timelines
+        of a random `share` of the users `recipients` selects.
+
+        Timelines that lose entries are marked incomplete.
+        """
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            sampled = select([recipients.c.user_id])
+            if share < 1:
+                sampled = sampled.where(func.random() < share)
+            sampled = sampled.alias('sampled')
+
+            # each sampled timeline's oldest entry to keep, read off the
+            # index, and everything older than it deleted in one go
+            kept = cls.__table__.alias('kept')
+            oldest_kept = (select([kept.c.timestamp, kept.c.message_id])
+                           .where(kept.c.user_id == sampled.c.user_id)
+                           .order_by(kept.c.timestamp.desc(),
+                                     kept.c.message_id.desc())
+                           .offset(TIMELINE_LENGTH - 1)
+                           .limit(1)
+                           .lateral('oldest_kept'))
+            cutoffs = (select([sampled.c.user_id, oldest_kept.c.timestamp,
+                               oldest_kept.c.message_id])
+                       .select_from(sampled.join(oldest_kept, true()))
+                       .alias('cutoffs'))
+
+            trimmed = db.session.execute(
+                cls.__table__.delete()
+                .where(cls.user_id == cutoffs.c.user_id)
+                .where(tuple_(cls.timestamp, cls.message_id)
+                       < tuple_(cutoffs.c.timestamp, cutoffs.c.message_id))
+                .returning(cls.user_id))
+            cls.mark_incomplete({user_id for (user_id,) in trimmed})
+            return
+
+        user_ids = [user_id for (user_id,) in
+                    db.session.execute(select([recipients.c.user_id]))
+                    if random.random() < share]
+        trimmed = set()
+
+        for user_id in user_ids:
+            oldest_kept = (db.session
+                           .query(cls.timestamp, cls.message_id)
+                           .filter(cls.user_id == user_id)
+                           .order_by(cls.timestamp.desc(),
+                                     cls.message_id.desc())
+                           .offset(TIMELINE_LENGTH - 1)
+                           .first())
+            if oldest_kept is not None and (
+                    cls.query
+                    .filter(cls.user_id == user_id,
+                            tuple_(cls.timestamp, cls.message_id)
+                            < tuple_(*oldest_kept))
+                    .delete(synchronize_session=False)):
+                trimmed.add(user_id)
+
+        cls.mark_incomplete(trimmed)
+
+    @staticmethod
+    def mark_incomplete(user_ids):
+        """Record that the timelines of `user_ids` are missing entries."""
+
+        if user_ids:
+            (User.query
+             .filter(User.id.in_(user_ids), User.timeline_complete)
+             .update({'timeline_complete': False},
+                     synchronize_session=False))
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy `author_id`'s newest messages into `user_id`'s timeline.
+
+        An incomplete timeline only gets messages newer than its oldest
+        entry: older ones would hide other followed users' messages that
+        are missing from it, as the homepage reads the timeline to its
+        end before it looks for more.
+        """
+
+        already_there = (select([cls.message_id])
+                         .where(cls.user_id == user_id))
+
+        newest = (select([literal(user_id), Message.id, Message.timestamp])
+                  .where(Message.user_id == author_id)
+                  .where(~Message.id.in_(already_there))
+                  .order_by(Message.timestamp.desc())
+                  .limit(TIMELINE_LENGTH))
+
+        complete = (db.session.query(User.timeline_complete)
+                    .filter(User.id == user_id)
+                    .scalar())
+
+        if not complete:
+            oldest = (db.session
+                      .query(cls.timestamp, cls.message_id)
+                      .filter(cls.user_id == user_id)
+                      .order_by(cls.timestamp, cls.message_id)
+                      .first())
+            if oldest is None:
+                return
+            newest = newest.where(tuple_(Message.timestamp, Message.id)
+                                  > tuple_(*oldest))
+
+        copied = db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], newest)).rowcount
+
+        # the author may have older messages that didn't fit
+        if copied >= TIMELINE_LENGTH:
+            cls.mark_incomplete({user_id})
+
+        cls.trim(select([literal(user_id).label('user_id')]).alias())
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop every message by `author_id` from `user_id`'s timeline."""
+
+        authored = select([Message.id]).where(Message.user_id == author_id)
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.message_id.in_(authored))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user):
+        """Recompute `user`'s timeline from scratch and mark it ready (and
+        complete, if every message fitted)."""
+
+        cls.query.filter(cls.user_id == user.id).delete(
+            synchronize_session=False)
+
+        authors = union(
+            select([Follows.user_being_followed_id.label('user_id')])
+            .where(Follows.user_following_id == user.id),
+            select([literal(user.id).label('user_id')]),
+        )
+
+        newest = (select([literal(user.id), Message.id, Message.timestamp])
+                  .where(Message.user_id.in_(authors))
+                  .order_by(Message.timestamp.desc())
+                  .limit(TIMELINE_LENGTH))
+
+        copied = db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], newest)).rowcount
+
+        user.timeline_ready = True
+        user.timeline_complete = copied < TIMELINE_LENGTH
+
+
+class TrendingMessage(db.Model):
+    """A message's like count, decayed over time, for the trending page.
+
+    Rather than shrinking every message's score as time passes, each like
+    adds a weight that grows over time instead: 2 ** (half lives since
+    TRENDING_EPOCH). All messages would decay by the same factor, so
+    ranking by these totals is ranking by decayed like counts, and a like
+    only ever touches its own message's row. `score` holds the log of the
+    total, which keeps it small however far from the epoch we get.
+
+    Only the top rows are kept (see `compact`), so the table stays small
+    and the page is one short read of the score index.
+    """
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # likes made since then are all in `score`; older ones (from before the
+    # row was added, or before `compact` last dropped it) aren't
+    counted_since = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_trending_messages_score', 'score'),
+    )
+
+    @staticmethod
+    def weight(when):
+        """Log of the weight of a like made at `when`."""
+
+        half_lives = ((when - TRENDING_EPOCH).total_seconds()
+                      / TRENDING_HALF_LIFE.total_seconds())
+        return half_lives * math.log(2)
+
+    @classmethod
+    def add_like(cls, message_id, liked_at):
+        """Count a like of `message_id` made at `liked_at`."""
+
+        weight = cls.weight(liked_at)
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # log(e ** score + e ** weight), without overflowing
+            combined = (func.greatest(cls.score, weight)
+                        + func.ln(1 + func.exp(-func.abs(cls.score - weight))))
+
+            insert = postgresql.insert(cls.__table__).values(
+                message_id=message_id, score=weight, counted_since=liked_at)
+            db.session.execute(insert.on_conflict_do_update(
+                index_elements=['message_id'],
+                set_={'score': combined.self_group()}))
+            return
+
+        # other databases may lack ln() and exp(), so the sum is worked
+        # out here
+        score = (db.session.query(cls.score)
+                 .filter(cls.message_id == message_id)
+                 .scalar())
+
+        if score is None:
+            db.session.execute(cls.__table__.insert().values(
+                message_id=message_id, score=weight, counted_since=liked_at))
+        else:
+            (cls.query
+             .filter(cls.message_id == message_id)
+             .update({cls.score: max(score, weight)
+                      + math.log1p(math.exp(-abs(score - weight)))},
+                     synchronize_session=False))
+
+    @classmethod
+    def remove_like(cls, message_id, liked_at):
+        """Stop counting a like of `message_id` made at `liked_at`, if it
+        was counted."""
+
+        weight = cls.weight(liked_at)
+        counted = ((cls.message_id == message_id)
+                   & (cls.counted_since <= liked_at))
+
+        # a message whose last counted like this was is left out
+        gone = cls.score <= weight + 1e-9
+        cls.query.filter(counted, gone).delete(synchronize_session=False)
+
+        # log(e ** score - e ** weight); other databases may lack ln() and
+        # exp(), so for them it's worked out here
+        if db.session.get_bind().dialect.name == 'postgresql':
+            remaining = cls.score + func.ln(1 - func.exp(weight - cls.score))
+        else:
+            score = db.session.query(cls.score).filter(counted).scalar()
+            if score is None:
+                return
+            remaining = score + math.log1p(-math.exp(weight - score))
+
+        cls.query.filter(counted).update({cls.score: remaining},
+                                         synchronize_session=False)
+
+    @classmethod
+    def compact(cls, keep, min_likes, now=None):
+        """Drop messages outside the top `keep`, or whose decayed like
+        count is below `min_likes`."""
+
+        now = now or datetime.utcnow()
+        floor = cls.weight(now) + math.log(min_likes)
+
+        cls.query.filter(cls.score < floor).delete(synchronize_session=False)
+
+        cutoff = (db.session.query(cls.score)
+                  .order_by(cls.score.desc())
+                  .offset(keep)
+                  .limit(1)
+                  .scalar())
+        if cutoff is not None:
+            cls.query.filter(cls.score <= cutoff).delete(
+                synchronize_session=False)
+
+
+class Job(db.Model):
+    """A piece of deferred work waiting in the job queue (see jobs.py).
+
+    Jobs are deleted once they succeed; ones that fail too often stay,
+    marked failed, for a person to look at.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # name of the function to run, and its keyword arguments
+    task = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # only one pending job may have a given key (running ones don't count)
+    key = db.Column(
+        db.Text,
+    )
+
+    # pending, running (leased to a worker) or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+        server_default='pending',
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # a worker is running it until then; if the worker dies, it's retried
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_queued_run_at', 'run_at',
+                 postgresql_where=db.text(
+                     "status IN ('pending', 'running')")),
+        db.Index('uq_jobs_pending_key', 'key', unique=True,
+                 postgresql_where=db.text("status = 'pending'"),
+                 sqlite_where=db.text("status = 'pending'")),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
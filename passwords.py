@@ -0,0 +1,110 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so a burst of logins can tie up every request
+worker's CPU at once. Hashes run on a small shared thread pool instead (the
+bcrypt library releases the GIL while hashing), capped at a fixed number of
+running plus waiting jobs. When that's full we fail fast with
+`PasswordHasherBusy` rather than letting requests pile up behind it.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already running or waiting."""
+
+
+class PasswordHasher:
+    """Hash and check passwords on a bounded thread pool.
+
+    Settings (read from app config by `init_app`):
+
+    - BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes
+    - PASSWORD_HASH_WORKERS: hashes run at once (default: one per core)
+    - PASSWORD_HASH_QUEUE: further hashes allowed to wait for a worker
+    - PASSWORD_HASH_WAIT: seconds to wait for room before giving up
+    """
+
+    def __init__(self, rounds=12, workers=None, queue=None, wait=0.1):
+        self.configure(rounds, workers, queue, wait)
+
+    def init_app(self, app):
+        """Configure from `app`'s settings."""
+
+        self.configure(
+            app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            app.config.get('PASSWORD_HASH_WORKERS'),
+            app.config.get('PASSWORD_HASH_QUEUE'),
+            app.config.get('PASSWORD_HASH_WAIT', 0.1),
+        )
+
+    def configure(self, rounds, workers=None, queue=None, wait=0.1):
+        """(Re)build the pool with these settings."""
+
+        workers = workers or os.cpu_count() or 1
+        if queue is None:
+            queue = workers * 2
+
+        old_executor = getattr(self, '_executor', None)
+
+        self.rounds = rounds
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+        # hashes already running on the old pool finish there, and give
+        # their slots back to the old semaphore
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        executor, slots = self._executor, self._slots
+
+        if not slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy()
+
+        try:
+            try:
+                future = executor.submit(fn, *args)
+            except RuntimeError:
+                # reconfigured since we looked; use the new pool instead
+                if executor is self._executor:
+                    raise
+                future = self._executor.submit(fn, *args)
+
+            return future.result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """Hash `password` with the configured work factor."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password,
+                           self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed` password?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
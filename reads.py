@@ -0,0 +1,113 @@
+"""Running a request's independent database reads at the same time.
+
+Most of a page's time goes on waiting for the database, one query after
+another. Where two queries don't depend on each other (say, a user and a
+page of their messages), `reads.run` can send them together and wait for
+both, so the page waits for the slower query rather than the sum of the
+two.
+
+This only shortens the request. The worker serving it is still tied up
+for as long as it runs, and each extra query holds a pool thread and a
+database connection meanwhile.
+
+Each extra query runs on a small shared thread pool, in its own copy of
+the request context with its own database session and connection (still
+going to the request's replica, under its statement timeout). Whatever
+model instances it returns are merged into the request's session, without
+querying again. Calls must not use `request` or `g.user`; pass in what
+they need instead.
+
+With CONCURRENT_READS set to 0 (the default) calls just run one after
+another.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import _request_ctx_stack, g, has_request_context
+
+from models import db
+
+# what a worker's copy of the request needs from `g`
+SHARED_STATE = ('db_replica', 'statement_timeout_ms')
+
+
+class ConcurrentReads:
+    """Run independent reads on a bounded thread pool.
+
+    Settings (read from app config by `init_app`):
+
+    - CONCURRENT_READS: threads for extra queries (0 to run in turn)
+    """
+
+    def __init__(self):
+        self._executor = None
+
+    def init_app(self, app):
+        """Configure from `app`'s settings."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+        workers = app.config.get('CONCURRENT_READS', 0)
+        if workers:
+            self._executor = ThreadPoolExecutor(max_workers=workers,
+                                                thread_name_prefix='reads')
+
+    def run(self, *calls):
+        """Call each of `calls` and return a list of their results.
+
+        The first runs here, in the request's own session; the rest run
+        alongside it on the pool.
+        """
+
+        if self._executor is None or not has_request_context():
+            return [call() for call in calls]
+
+        state = {key: g.get(key) for key in SHARED_STATE}
+        counting = 'sql_statements' in g
+
+        futures = [
+            self._executor.submit(self._call, _request_ctx_stack.top.copy(),
+                                  state, counting, call)
+            for call in calls[1:]
+        ]
+
+        results = [calls[0]()]
+
+        for future in futures:
+            result, statements = future.result()
+            results.append(merge(result))
+            if counting:
+                g.sql_statements += statements
+
+        return results
+
+    @staticmethod
+    def _call(context, state, counting, call):
+        """Run `call` in a copy of the request; return its result and how
+        many SQL statements it sent."""
+
+        # popping the context removes this thread's database session
+        with context:
+            for key, value in state.items():
+                setattr(g, key, value)
+            if counting:
+                g.sql_statements = 0
+
+            return call(), g.get('sql_statements', 0)
+
+
+def merge(result):
+    """Attach the model instances in `result` to this request's session."""
+
+    if isinstance(result, db.Model):
+        return db.session.merge(result, load=False)
+
+    if isinstance(result, (list, tuple)):
+        return type(result)(merge(item) for item in result)
+
+    return result
+
+
+reads = ConcurrentReads()
@@ -1,20 +1,221 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams each CSV into the database in batches, so memory use stays flat
+however big the files are. On PostgreSQL each batch is loaded with COPY;
+other databases get a batched executemany.
+
+Every batch is committed together with a note of how far that file has
+got, so an interrupted load can carry on where it stopped:
+
+    python seed.py                      # drop and recreate tables, load
+    python seed.py --resume             # continue an interrupted load
+    python seed.py --batch-size 50000 --data-dir /data/warbler-1m
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User
+
+# Tables to load, in foreign key order. Missing files are skipped.
+TABLES = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+]
+
+DEFAULT_BATCH_SIZE = 10000
+
+# How many rows of each file are safely loaded; kept apart from the app's
+# own tables so it's only ever created by the loader
+seed_progress = Table(
+    'seed_progress', MetaData(),
+    Column('filename', Text, primary_key=True),
+    Column('rows', Integer, nullable=False),
+)
+
+
+def converter(column):
+    """How to turn a CSV string into a value for `column`.
+
+    An empty cell becomes the column's default, if it has a plain one, or
+    else NULL, as it would with COPY.
+    """
+
+    if isinstance(column.type, db.DateTime):
+        convert = datetime.fromisoformat
+    elif isinstance(column.type, db.Integer):
+        convert = int
+    else:
+        convert = str
+
+    empty = None
+    if column.default is not None and column.default.is_scalar:
+        empty = column.default.arg
+
+    return lambda value: convert(value) if value != '' else empty
+
+
+def missing_defaults(table, columns):
+    """Values for `table`'s required columns that the CSV (with header
+    `columns`) leaves out, from the columns' Python defaults.
+
+    COPY and the executemany only fill in the database's own defaults, so
+    without these an older CSV (eg likes without their times) would fail
+    the NOT NULL constraint. Callable defaults are called once, at load
+    time. Returns a dict of column name to CSV string.
+    """
+
+    filled = {}
+
+    for column in table.columns:
+        default = column.default
+        if (column.name in columns or column.nullable
+                or column.server_default is not None or default is None
+                or not (default.is_scalar or default.is_callable)):
+            continue
+
+        value = default.arg(None) if default.is_callable else default.arg
+        filled[column.name] = str(value)
+
+    return filled
+
+
+def rows_loaded(filename):
+    """How many rows of `filename` earlier runs have committed."""
+
+    rows = (db.session
+            .query(seed_progress.c.rows)
+            .filter(seed_progress.c.filename == filename)
+            .scalar())
+
+    return rows or 0
+
+
+def record_progress(filename, rows):
+    """Note (in the current transaction) that `rows` rows are loaded."""
+
+    updated = db.session.execute(
+        seed_progress.update()
+        .where(seed_progress.c.filename == filename)
+        .values(rows=rows)).rowcount
+
+    if not updated:
+        db.session.execute(
+            seed_progress.insert().values(filename=filename, rows=rows))
+
+
+def copy_batch(table, columns, batch):
+    """Load `batch` (lists of CSV strings) with PostgreSQL's COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(batch)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH CSV",
+        buffer)
+
+
+def insert_batch(table, columns, batch):
+    """Load `batch` (lists of CSV strings) with a batched executemany."""
+
+    convert = [converter(table.c[column]) for column in columns]
+
+    db.session.execute(table.insert(), [
+        {column: fn(value) for column, fn, value in zip(columns, convert, row)}
+        for row in batch
+    ])
+
+
+def load_csv(table, path, batch_size):
+    """Stream the CSV at `path` into `table`, picking up after any rows
+    an earlier run already loaded."""
+
+    filename = os.path.basename(path)
+    load_batch = (copy_batch
+                  if db.engine.dialect.name == 'postgresql'
+                  else insert_batch)
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+        filled = missing_defaults(table, columns)
+
+        done = rows_loaded(filename)
+        if done:
+            print(f"{filename}: resuming after {done} rows")
+            for _ in islice(reader, done):
+                pass
+
+        start = time.monotonic()
+        loaded = 0
+
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                break
+
+            if filled:
+                batch = [row + list(filled.values()) for row in batch]
+            load_batch(table, columns + list(filled), batch)
+            loaded += len(batch)
+            record_progress(filename, done + loaded)
+            db.session.commit()
+
+            rate = loaded / (time.monotonic() - start)
+            print(f"{filename}: {done + loaded} rows ({rate:.0f} rows/sec)")
+
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load Warbler's sample data CSVs into the database.")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"rows per transaction "
+                             f"(default {DEFAULT_BATCH_SIZE})")
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding the CSVs (default generator)")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load instead of "
+                             "starting from empty tables")
+    args = parser.parse_args()
+
+    if not args.resume:
+        seed_progress.drop(db.engine, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+
+    seed_progress.create(db.engine, checkfirst=True)
 
+    start = time.monotonic()
+    total = 0
 
-db.drop_all()
-db.create_all()
+    for table_name, filename in TABLES:
+        path = os.path.join(args.data_dir, filename)
+        if os.path.exists(path):
+            total += load_csv(db.metadata.tables[table_name], path,
+                              args.batch_size)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    # bulk loads skip the routes that keep the stats counters up to date
+    User.reconcile_counts()
+    db.session.commit()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    elapsed = time.monotonic() - start
+    print(f"Loaded {total} rows in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):.0f} rows/sec)")
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
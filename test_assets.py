@@ -0,0 +1,86 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+from assets import assets, build, DIST_DIR
+
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.static = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(app.static_folder, self.static,
+                        ignore=shutil.ignore_patterns(DIST_DIR))
+        self.manifest = build(self.static)
+        assets.load(os.path.join(self.static, DIST_DIR))
+
+    def tearDown(self):
+        assets.load(os.path.join(app.static_folder, DIST_DIR))
+        shutil.rmtree(os.path.dirname(self.static))
+
+    def test_build(self):
+        """Are files fingerprinted, and stylesheets pointed at them?"""
+
+        css = self.manifest['files']['stylesheets/style.css']
+        logo = self.manifest['files']['images/warbler-logo.png']
+
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertIn('gzip', self.manifest['encodings'][css])
+        self.assertNotIn(logo, self.manifest['encodings'])
+
+        with open(os.path.join(self.static, DIST_DIR, css)) as f:
+            self.assertIn(
+                f"/assets/{self.manifest['files']['images/nav-bg.png']}",
+                f.read())
+
+    def test_serves_precompressed(self):
+        """Is the gzipped copy sent when accepted, and cached forever?"""
+
+        css = self.manifest['files']['stylesheets/style.css']
+
+        with app.test_client() as client:
+            response = client.get(f'/assets/{css}',
+                                  headers={'Accept-Encoding': 'gzip, br'})
+            body = response.get_data()
+            response.close()
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertIn('immutable', response.headers['Cache-Control'])
+
+            with open(os.path.join(self.static, DIST_DIR, css), 'rb') as f:
+                self.assertEqual(gzip.decompress(body), f.read())
+
+            response = client.get(f'/assets/{css}')
+            response.close()
+            self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_templates_link_built_assets(self):
+        """Do pages link to the fingerprinted stylesheet?"""
+
+        css = self.manifest['files']['stylesheets/style.css']
+
+        with app.test_client() as client:
+            html = client.get('/signup').get_data(as_text=True)
+
+        self.assertIn(f'href="/assets/{css}"', html)
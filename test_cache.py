@@ -0,0 +1,65 @@
+"""LRU cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_evicts_least_recently_used(self):
+        """Does a full cache drop the entry used longest ago?"""
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires_after_ttl(self):
+        """Are entries dropped once they're older than the ttl?"""
+
+        cache = LRUCache(10, ttl=30)
+
+        with patch('cache.time.monotonic', return_value=100):
+            cache.set('a', 1)
+
+        with patch('cache.time.monotonic', return_value=129):
+            self.assertEqual(cache.get('a'), 1)
+
+        with patch('cache.time.monotonic', return_value=131):
+            self.assertEqual(cache.get('a'), None)
+
+    def test_delete(self):
+        """Does delete forget only the given keys?"""
+
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a', 'missing')
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_delete_matching(self):
+        """Does delete_matching forget only the keys that match?"""
+
+        cache = LRUCache(10)
+        cache.set((1, 'a'), 1)
+        cache.set((2, 'a'), 2)
+        cache.set((3, 'b'), 3)
+        cache.delete_matching(lambda key, value: key[1] == 'a')
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get((3, 'b')), 3)
@@ -0,0 +1,143 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+from jobs import jobs
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# calls to the test task, and how many of them should fail first
+calls = []
+failures = []
+
+
+@jobs.task
+def record(value):
+    calls.append(value)
+    if failures:
+        failures.pop()
+        raise RuntimeError("failing on purpose")
+
+
+class JobQueueTestCase(TestCase):
+    """Are jobs queued, run once per key, and retried with backoff?"""
+
+    def setUp(self):
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        calls.clear()
+        failures.clear()
+        jobs.queued = True
+
+    def tearDown(self):
+        db.session.rollback()
+        jobs.queued = False
+
+    def test_runs_once_per_key(self):
+        """Does a second job with a pending key get dropped?"""
+
+        jobs.enqueue('record', key='same', value=1)
+        jobs.enqueue('record', key='same', value=2)
+        jobs.enqueue('record', value=3)
+        db.session.commit()
+
+        self.assertEqual(calls, [])
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(sorted(calls), [1, 3])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_running_job_lets_key_queue(self):
+        """Can a job be queued behind a running one with its key, and does
+        the running one give way to it if it fails?"""
+
+        jobs.enqueue('record', key='same', value=1)
+        db.session.commit()
+
+        job_id, task, args = jobs.claim()
+        self.assertEqual(Job.query.get(job_id).status, 'running')
+
+        jobs.enqueue('record', key='same', value=2)
+        db.session.commit()
+        self.assertEqual(Job.query.count(), 2)
+
+        jobs.retry_later(job_id, RuntimeError("failing on purpose"))
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.args), ('pending', {'value': 2}))
+
+    def test_retries_then_fails(self):
+        """Is a failing job retried later, then marked failed?"""
+
+        failures.extend([True] * jobs.max_attempts)
+        jobs.enqueue('record', value=1)
+        db.session.commit()
+
+        jobs.run_pending()
+
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.status, 'pending')
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn('failing on purpose', job.last_error)
+
+        for attempt in range(jobs.max_attempts - 1):
+            job.run_at = datetime.utcnow()
+            db.session.commit()
+            jobs.run_pending()
+            job = Job.query.one()
+
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(len(calls), jobs.max_attempts)
+
+        # failed jobs don't run again
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_fan_out_deferred(self):
+        """Do followers get a new message only once its job has run?"""
+
+        author = User(username="author", email="author@test.com",
+                      password="password")
+        follower = User(username="follower", email="follower@test.com",
+                        password="password")
+        db.session.add_all([author, follower])
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=follower.id))
+        db.session.commit()
+        author_id, follower_id = author.id, follower.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = author_id
+
+            client.post('/messages/new', data={"text": "Deferred"})
+
+        recipients = {entry.user_id for entry in TimelineEntry.query}
+        self.assertEqual(recipients, {author_id})
+
+        jobs.run_pending()
+
+        recipients = {entry.user_id for entry in TimelineEntry.query}
+        self.assertEqual(recipients, {author_id, follower_id})
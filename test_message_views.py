@@ -6,9 +6,13 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy.exc import IntegrityError
+
+from models import (db, connect_db, Message, User, Follows, Likes,
+                    TimelineEntry, TrendingMessage)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +24,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -91,8 +95,280 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(Message.query.first(), None)
-            
 
+    def test_delete_others_message(self):
+        """Is deleting someone else's message refused?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="other",
+                            image_url=None)
+        db.session.commit()
+        other_id = other.id
+        message_id = self.testmessage.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            resp = c.post(f"/messages/{message_id}/delete",
+                          follow_redirects=True)
+
+            self.assertIn("Access unauthorized", resp.get_data(as_text=True))
+            self.assertIsNotNone(Message.query.get(message_id))
+
+    def test_add_message_fans_out(self):
+        """Does a new message land in the author's and followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                               user_following_id=follower.id))
+        db.session.commit()
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            msg = Message.query.filter_by(text="Fanned out").one()
+            recipients = {e.user_id for e in
+                          TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(recipients, {self.testuser.id, follower_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            self.assertIn("Fanned out", resp.get_data(as_text=True))
+
+    def test_delete_message_removes_from_timelines(self):
+        """Does deleting a message take it out of timelines?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Short lived"})
+            msg = Message.query.filter_by(text="Short lived").one()
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_message_counters(self):
+        """Do adding, liking and deleting messages keep counters right?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="liker",
+                            image_url=None)
+        db.session.commit()
+        liker_id = liker.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Counted"})
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
+
+            msg = Message.query.filter_by(text="Counted").one()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            c.post(f"/messages/{msg.id}/like", headers={"Referer": "/"})
+            self.assertEqual(User.query.get(liker_id).likes_count, 1)
+
+            # caches the liker, with their likes count of 1
+            c.get("/")
+            self.assertIsNotNone(user_cache.get(liker_id))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 0)
+            self.assertEqual(User.query.get(liker_id).likes_count, 0)
+            self.assertIsNone(user_cache.get(liker_id))
+
+    def test_like_toggle(self):
+        """Does liking twice unlike, and liking your own message do nothing?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="liker",
+                            image_url=None)
+        db.session.commit()
+        liker_id = liker.id
+        msg_id = self.testmessage.id
+        testuser_id = self.testuser.id
 
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+
+            c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(Likes.query.filter_by(user_id=liker_id).count(), 1)
+
+            c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(Likes.query.filter_by(user_id=liker_id).count(), 0)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post(f"/messages/{msg_id}/like",
+                          follow_redirects=True)
+            self.assertIn("can&#39;t like your own", resp.get_data(as_text=True))
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_duplicate_like_rejected(self):
+        """Does the database refuse a second like of the same message?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="other",
+                            image_url=None)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=other.id, message_id=self.testmessage.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=other.id, message_id=self.testmessage.id))
+        self.assertRaises(IntegrityError, db.session.commit)
+        db.session.rollback()
+
+
+    def test_message_not_modified(self):
+        """Is an unchanged message page a 304 for anonymous visitors?"""
+
+        msg_id = self.testmessage.id
+
+        response = self.client.get(f'/messages/{msg_id}')
+        etag = response.headers['ETag']
+        self.assertIn('public', response.headers['Cache-Control'])
+
+        response = self.client.get(f'/messages/{msg_id}',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_likes_page(self):
+        """Are liked messages listed most recently liked first, marked by
+        whether the viewer liked them?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="liker",
+                            image_url=None)
+        viewer = User.signup(username="viewer",
+                             email="viewer@test.com",
+                             password="viewer",
+                             image_url=None)
+        newer = Message(text="Posted later", user_id=self.testuser.id)
+        db.session.add(newer)
+        db.session.commit()
+        liker_id, viewer_id = liker.id, viewer.id
+
+        # liked in the opposite order to when they were posted
+        for msg_id in (newer.id, self.testmessage.id):
+            db.session.add(Likes(user_id=liker_id, message_id=msg_id))
+            db.session.commit()
+        db.session.add(Likes(user_id=viewer_id, message_id=newer.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer_id
+
+            html = c.get(f"/users/{liker_id}/likes").get_data(as_text=True)
+
+        self.assertLess(html.index("This is a message"),
+                        html.index("Posted later"))
+        self.assertEqual(html.count("fa fa-star"), 1)
+        self.assertLess(html.index("Posted later"), html.index("fa fa-star"))
+
+    def test_trending(self):
+        """Are the most liked messages first, and do unlikes count back
+        down?"""
+
+        fans = [User.signup(username=f"fan{i}",
+                            email=f"fan{i}@test.com",
+                            password="fan",
+                            image_url=None) for i in range(2)]
+        quiet = Message(text="Liked once", user_id=self.testuser.id)
+        db.session.add(quiet)
+        db.session.commit()
+        fan_ids = [fan.id for fan in fans]
+        popular_id, quiet_id = self.testmessage.id, quiet.id
+
+        with self.client as c:
+            for fan_id, msg_ids in ((fan_ids[0], [quiet_id, popular_id]),
+                                    (fan_ids[1], [popular_id])):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan_id
+                for msg_id in msg_ids:
+                    c.post(f"/messages/{msg_id}/like")
+
+            html = c.get("/trending").get_data(as_text=True)
+            self.assertLess(html.index("This is a message"),
+                            html.index("Liked once"))
+
+            # the second fan unlikes it, then the first fan too
+            c.post(f"/messages/{popular_id}/like")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_ids[0]
+            c.post(f"/messages/{popular_id}/like")
+
+            html = c.get("/trending").get_data(as_text=True)
+            self.assertIn("Liked once", html)
+            self.assertNotIn("This is a message", html)
+
+    def test_trending_ignores_uncounted_unlikes(self):
+        """Does unliking leave a score alone if the like was made before
+        the message's row started counting?"""
+
+        now = datetime.utcnow()
+        msg_id = self.testmessage.id
+        TrendingMessage.add_like(msg_id, now)
+        db.session.commit()
+
+        score = TrendingMessage.query.get(msg_id).score
+        TrendingMessage.remove_like(msg_id, now - timedelta(hours=1))
+        db.session.commit()
+        self.assertEqual(TrendingMessage.query.get(msg_id).score, score)
+
+        TrendingMessage.remove_like(msg_id, now)
+        db.session.commit()
+        self.assertIsNone(TrendingMessage.query.get(msg_id))
+
+    def test_trending_compaction(self):
+        """Are messages dropped once their likes have decayed, or when
+        they fall out of the top few?"""
+
+        msg_ids = [self.testmessage.id]
+        for i in range(2):
+            msg = Message(text=f"Another {i}", user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_ids.append(msg.id)
+
+        now = datetime.utcnow()
+        for count, msg_id in enumerate(msg_ids, 1):
+            for _ in range(count):
+                TrendingMessage.add_like(msg_id, now)
+        db.session.commit()
 
+        TrendingMessage.compact(keep=2, min_likes=0.5, now=now)
+        self.assertEqual({t.message_id for t in TrendingMessage.query},
+                         set(msg_ids[1:]))
 
+        # two days on, three likes have decayed to almost nothing
+        TrendingMessage.compact(keep=2, min_likes=0.5,
+                                now=now + timedelta(days=2))
+        self.assertEqual(TrendingMessage.query.count(), 0)
@@ -0,0 +1,118 @@
+"""Request/SQL metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine, event
+
+from metrics import Metrics
+
+
+def make_app(**config):
+    """A tiny app whose one page runs two SQL statements."""
+
+    app = Flask(__name__)
+    app.config.update(config)
+    engine = create_engine("postgresql:///warbler-test")
+
+    @app.route('/two-queries')
+    def two_queries():
+        with engine.connect() as conn:
+            conn.execute("SELECT 1")
+            conn.execute("SELECT 2")
+        return "ok"
+
+    metrics = Metrics()
+    metrics.init_app(app, {'primary': engine})
+    return app, engine, metrics
+
+
+class MetricsTestCase(TestCase):
+    """Test the request/SQL instrumentation."""
+
+    def test_disabled_installs_nothing(self):
+        """With metrics and the slow query log off, are there no hooks?"""
+
+        app, engine, metrics = make_app(METRICS_ENABLED=False, SLOW_QUERY_MS=0)
+
+        self.assertFalse(event.contains(engine, 'before_cursor_execute',
+                                        metrics._before_cursor_execute))
+        self.assertEqual(app.before_request_funcs, {})
+
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 404)
+
+    def test_records_requests_and_sql(self):
+        """Are requests, statements and pool waits counted per endpoint?"""
+
+        app, engine, metrics = make_app(METRICS_ENABLED=True,
+                                        METRICS_TOKEN='sekrit')
+
+        with app.test_client() as client:
+            client.get('/two-queries')
+            client.get('/two-queries')
+            resp = client.get('/metrics', headers={
+                'Authorization': 'Bearer sekrit'})
+
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram',
+                      text)
+        self.assertIn('warbler_requests_total{endpoint="two_queries",'
+                      'method="GET",status="200"} 2', text)
+        self.assertIn('warbler_sql_statements_total{endpoint="two_queries"} 4',
+                      text)
+        self.assertIn('warbler_request_sql_statements_bucket'
+                      '{endpoint="two_queries",le="2"} 2', text)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="two_queries"} 2', text)
+        self.assertIn('warbler_db_pool_checkout_wait_seconds_count'
+                      '{endpoint="two_queries"}', text)
+        self.assertIn('warbler_db_pool_checked_out{database="primary"} 0',
+                      text)
+        self.assertIn('warbler_db_pool_size{database="primary"} 5', text)
+
+        # scraping doesn't count itself
+        self.assertNotIn('endpoint="metrics"', text)
+
+    def test_scraping_needs_token(self):
+        """Is /metrics kept from anyone without the token, and from
+        everyone when there's no token?"""
+
+        app, engine, metrics = make_app(METRICS_ENABLED=True,
+                                        METRICS_TOKEN='sekrit')
+
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 403)
+            self.assertEqual(client.get('/metrics', headers={
+                'Authorization': 'Bearer wrong'}).status_code, 403)
+            self.assertEqual(client.get('/metrics', headers={
+                'Authorization': 'Bearer sekrit'}).status_code, 200)
+
+        app, engine, metrics = make_app(METRICS_ENABLED=True)
+
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 403)
+            self.assertEqual(client.get('/metrics', headers={
+                'Authorization': 'Bearer '}).status_code, 403)
+
+    def test_slow_query_log(self):
+        """Are statements over SLOW_QUERY_MS logged with their endpoint?"""
+
+        app, engine, metrics = make_app(SLOW_QUERY_MS=5)
+
+        with app.test_request_context('/two-queries'):
+            with self.assertLogs('warbler.slow_queries') as logs:
+                with engine.connect() as conn:
+                    conn.execute("SELECT 1")
+                    conn.execute("SELECT pg_sleep(0.01)")
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('pg_sleep', logs.output[0])
+        self.assertIn('two_queries', logs.output[0])
@@ -0,0 +1,159 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+import migrations
+
+db.create_all()
+
+
+def run_sql(*statements):
+    with db.engine.connect() as connection:
+        for statement in statements:
+            connection.execute(statement)
+
+
+class MigrationsTestCase(TestCase):
+    """Do migrations bring an older schema up to date?"""
+
+    def setUp(self):
+        # start from an up to date schema
+        migrations.upgrade(db.engine, echo=lambda message: None)
+
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(username="u1", email="u1@test.com", password="password")
+        u2 = User(username="u2", email="u2@test.com", password="password")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msg = Message(text="hello", user_id=u1.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def forget(self, *versions):
+        """Make the database think `versions` were never applied."""
+
+        db.session.execute(migrations.schema_migrations.delete().where(
+            migrations.schema_migrations.c.version.in_(versions)))
+        db.session.commit()
+
+    def test_adds_missing_indexes(self):
+        """Are the lookup indexes rebuilt on a database that lacks them?"""
+
+        db.session.remove()
+        run_sql("DROP INDEX ix_messages_user_timestamp",
+                "DROP INDEX ix_follows_following",
+                "DROP INDEX ix_likes_message_id")
+        self.forget(5)
+
+        applied = migrations.upgrade(db.engine, echo=lambda message: None)
+
+        self.assertEqual(applied, [5])
+        indexes = {index['name'] for table in ('messages', 'follows', 'likes')
+                   for index in inspect(db.engine).get_indexes(table)}
+        self.assertTrue({'ix_messages_user_timestamp', 'ix_follows_following',
+                         'ix_likes_message_id'} <= indexes)
+
+    def test_marks_running_jobs(self):
+        """Are leased jobs marked running, and the due jobs index rebuilt
+        to include them?"""
+
+        db.session.remove()
+        run_sql("DELETE FROM jobs",
+                "DROP INDEX ix_jobs_queued_run_at",
+                "CREATE INDEX ix_jobs_pending_run_at ON jobs (run_at) "
+                "WHERE status = 'pending'",
+                "INSERT INTO jobs (task, args, status, run_at, attempts, "
+                "locked_until, created_at) VALUES ('record', '{}', "
+                "'pending', now(), 1, now(), now())")
+        self.forget(10)
+
+        applied = migrations.upgrade(db.engine, echo=lambda message: None)
+
+        self.assertEqual(applied, [10])
+        # (pg_indexes, as reflection warns about the partial indexes)
+        indexes = {name for (name,) in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'jobs'")}
+        self.assertIn('ix_jobs_queued_run_at', indexes)
+        self.assertNotIn('ix_jobs_pending_run_at', indexes)
+        self.assertEqual(db.session.execute(
+            "SELECT status FROM jobs").scalar(), 'running')
+        run_sql("DELETE FROM jobs")
+
+    def test_dedupes_likes_before_adding_constraint(self):
+        """Are duplicate likes removed so the unique constraint can go on?"""
+
+        db.session.remove()
+        run_sql("ALTER TABLE likes DROP CONSTRAINT uq_likes_user_message",
+                f"INSERT INTO likes (user_id, message_id, created_at) VALUES "
+                f"({self.u2_id}, {self.msg_id}, now()), "
+                f"({self.u2_id}, {self.msg_id}, now())")
+        self.forget(3)
+
+        migrations.upgrade(db.engine, echo=lambda message: None)
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+        constraints = {c['name'] for c in
+                       inspect(db.engine).get_unique_constraints('likes')}
+        self.assertIn('uq_likes_user_message', constraints)
+
+    def test_adds_and_fills_counter_columns(self):
+        """Are the counter columns added back, with the right counts?"""
+
+        db.session.remove()
+        run_sql("ALTER TABLE users DROP COLUMN messages_count")
+        self.forget(1)
+
+        migrations.upgrade(db.engine, echo=lambda message: None)
+
+        counts = {user.username: user.messages_count
+                  for user in User.query.all()}
+        self.assertEqual(counts, {'u1': 1, 'u2': 0})
+
+    def test_adds_like_times(self):
+        """Do existing likes get a time, with no default left behind?"""
+
+        db.session.add(Likes(user_id=self.u2_id, message_id=self.msg_id))
+        db.session.commit()
+        db.session.remove()
+        run_sql("DROP INDEX ix_likes_user_created",
+                "ALTER TABLE likes DROP COLUMN created_at")
+        self.forget(7)
+
+        applied = migrations.upgrade(db.engine, echo=lambda message: None)
+
+        self.assertEqual(applied, [7])
+        self.assertIsNotNone(Likes.query.one().created_at)
+        columns = {column['name']: column
+                   for column in inspect(db.engine).get_columns('likes')}
+        self.assertIsNone(columns['created_at']['default'])
+
+    def test_nothing_to_do(self):
+        """Does a second run apply nothing?"""
+
+        self.assertEqual(
+            migrations.upgrade(db.engine, echo=lambda message: None), [])
@@ -0,0 +1,66 @@
+"""Connection pool and statement timeout tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pool.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.pool import QueuePool
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.create_all()
+
+
+class PoolTestCase(TestCase):
+    """Are requests shed when the pool runs dry, and statements capped?"""
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['STATEMENT_TIMEOUT_MS_READ'] = 0
+
+    def test_pool_exhausted(self):
+        """Does a request that can't get a connection get a quick 503?"""
+
+        engine = db.engine
+        pool = engine.pool
+        engine.pool = QueuePool(pool._creator, pool_size=1, max_overflow=0,
+                                timeout=0.01)
+        held = engine.connect()
+
+        try:
+            with app.test_client() as client:
+                response = client.get('/users')
+        finally:
+            held.close()
+            engine.pool.dispose()
+            engine.pool = pool
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_statement_timeout(self):
+        """Do read requests run under the read statement timeout?"""
+
+        app.config['STATEMENT_TIMEOUT_MS_READ'] = 1500
+
+        with app.test_request_context('/users'):
+            app.preprocess_request()
+            timeout = db.session.execute('SHOW statement_timeout').scalar()
+            db.session.remove()
+
+        self.assertEqual(timeout, '1500ms')
+
+        with app.test_request_context('/users', method='POST'):
+            app.preprocess_request()
+            timeout = db.session.execute('SHOW statement_timeout').scalar()
+            db.session.remove()
+
+        self.assertEqual(timeout, '0')
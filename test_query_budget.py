@@ -0,0 +1,121 @@
+"""SQL statement budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budget.py
+#
+# Pages that list messages should issue the same number of SQL statements
+# however many messages (and authors) they show. These fail if a change
+# brings back a lazy load per row.
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+# Most SQL statements each route may issue, including loading g.user
+QUERY_BUDGETS = {
+    'homepage': 5,
+    'users_show': 5,
+    'show_likes': 5,
+    'show_following': 5,
+    'users_followers': 5,
+}
+
+NUM_AUTHORS = 20
+
+
+class QueryCounter:
+    """Count SQL statements sent to the database inside a `with` block."""
+
+    def __init__(self):
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+
+
+class QueryBudgetTestCase(TestCase):
+    """Do list pages stay within their SQL statement budgets?"""
+
+    def setUp(self):
+        """Create a user following and liking messages from many authors."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        reader = User(username="reader", email="reader@test.com",
+                      password="reader")
+        authors = [User(username=f"author{i}", email=f"author{i}@test.com",
+                        password="author")
+                   for i in range(NUM_AUTHORS)]
+        db.session.add_all([reader] + authors)
+        db.session.commit()
+
+        messages = [Message(text=f"Message by {author.username}",
+                            user_id=author.id)
+                    for author in authors]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        db.session.add_all(
+            [Follows(user_being_followed_id=author.id,
+                     user_following_id=reader.id) for author in authors]
+            + [Likes(user_id=reader.id, message_id=msg.id)
+               for msg in messages])
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = authors[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assertWithinBudget(self, endpoint, url):
+        """GET `url` as the reader and check the statements it ran."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.reader_id
+
+            with QueryCounter() as counter:
+                response = client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            counter.count, QUERY_BUDGETS[endpoint],
+            f"{url} ran {counter.count} SQL statements")
+
+    def test_homepage(self):
+        self.assertWithinBudget('homepage', '/')
+
+    def test_users_show(self):
+        self.assertWithinBudget('users_show', f'/users/{self.author_id}')
+
+    def test_show_likes(self):
+        self.assertWithinBudget('show_likes', f'/users/{self.reader_id}/likes')
+
+    def test_show_following(self):
+        self.assertWithinBudget('show_following',
+                                f'/users/{self.reader_id}/following')
+
+    def test_users_followers(self):
+        self.assertWithinBudget('users_followers',
+                                f'/users/{self.author_id}/followers')
@@ -0,0 +1,100 @@
+"""Concurrent read tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_reads.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, user_cache, fragment_cache
+
+from reads import reads
+
+db.create_all()
+
+
+class ConcurrentReadsTestCase(TestCase):
+    """Do pages come out the same when their reads run side by side?"""
+
+    def setUp(self):
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        reader = User(username="reader", email="reader@test.com",
+                      password="password")
+        author = User(username="author", email="author@test.com",
+                      password="password")
+        db.session.add_all([reader, author])
+        db.session.commit()
+
+        msg = Message(text="Concurrent hello", user_id=author.id)
+        db.session.add_all([msg, Follows(user_being_followed_id=author.id,
+                                         user_following_id=reader.id)])
+        db.session.commit()
+        db.session.add(Likes(user_id=reader.id, message_id=msg.id))
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.msg_id = msg.id
+
+        app.config['CONCURRENT_READS'] = 2
+        reads.init_app(app)
+        user_cache.clear()
+        fragment_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['CONCURRENT_READS'] = 0
+        reads.init_app(app)
+
+    def test_run(self):
+        """Do extra calls run on other threads, with their results merged
+        into this request's session?"""
+
+        with app.test_request_context('/'):
+            app.preprocess_request()
+
+            thread, user = reads.run(
+                lambda: threading.current_thread().name,
+                lambda: (threading.current_thread().name,
+                         User.query.get(self.author_id)))[1]
+
+            self.assertTrue(thread.startswith('reads'))
+            self.assertIn(user, db.session)
+            self.assertEqual(user.username, "author")
+            db.session.remove()
+
+    def test_homepage(self):
+        """Does the homepage show the timeline and the viewer's likes?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.reader_id
+
+            html = client.get('/').get_data(as_text=True)
+
+        self.assertIn('Concurrent hello', html)
+        self.assertIn('btn-primary', html)
+
+    def test_users_show(self):
+        """Does a profile show the user and their messages, or a 404?"""
+
+        with app.test_client() as client:
+            html = client.get(f'/users/{self.author_id}').get_data(
+                as_text=True)
+            missing = client.get('/users/0')
+
+        self.assertIn('@author', html)
+        self.assertIn('Concurrent hello', html)
+        self.assertEqual(missing.status_code, 404)
@@ -0,0 +1,80 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# A second database, warbler-test-replica, stands in for a replica. It's
+# given different data from the primary, so pages show which one they read.
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, user_cache, fragment_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Do reads go to the replica, except just after the user wrote?"""
+
+    def setUp(self):
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': REPLICA_URL}
+        app.config['DATABASE_REPLICAS'] = ['replica0']
+        self.replica = db.get_engine(app, bind='replica0')
+        db.metadata.create_all(self.replica)
+
+        for engine, name in ((db.engine, "PRIMARY"),
+                             (self.replica, "REPLICA")):
+            engine.execute(Message.__table__.delete())
+            engine.execute(User.__table__.delete())
+            engine.execute(User.__table__.insert().values(
+                id=1000, username=name, email=f"{name}@test.com",
+                password="password"))
+
+        user_cache.clear()
+        fragment_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['DATABASE_REPLICAS'] = []
+        app.config['READ_YOUR_WRITES_SECONDS'] = 10
+        user_cache.clear()
+
+    def test_reads_from_replica(self):
+        """Are GET requests answered from the replica?"""
+
+        with app.test_client() as client:
+            html = client.get('/users/1000').get_data(as_text=True)
+
+        self.assertIn('@REPLICA', html)
+
+    def test_reads_own_writes(self):
+        """Does a user who just wrote read from the primary, and go back to
+        the replica once the window has passed?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = 1000
+
+            client.post('/messages/new', data={"text": "Written"})
+
+            html = client.get('/users/1000').get_data(as_text=True)
+            self.assertIn('@PRIMARY', html)
+            self.assertIn('Written', html)
+
+            app.config['READ_YOUR_WRITES_SECONDS'] = 0
+            user_cache.clear()
+
+            html = client.get('/users/1000').get_data(as_text=True)
+            self.assertIn('@REPLICA', html)
+            self.assertNotIn('Written', html)
@@ -6,10 +6,12 @@
 
 
 import os
-from unittest import TestCase
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 from flask_bcrypt import Bcrypt
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
 from sqlalchemy import exc
+from passwords import hasher
 
 bcrypt = Bcrypt()
 
@@ -23,7 +25,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app
+from app import app, timeline_page
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -114,6 +116,142 @@ class UserModelTestCase(TestCase):
         self.assertEqual(user1.is_followed_by(user2), True)
         self.assertEqual(user2.is_followed_by(user1), False)
 
+    def test_following_among(self):
+        """Does following_among pick out only the followed users' ids?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user2 = User.query.filter(User.username == "TEST_USER2").first()
+
+        db.session.add(Follows(user_being_followed_id=user2.id,
+                               user_following_id=user1.id))
+        db.session.commit()
+
+        self.assertEqual(user1.following_among([user1.id, user2.id]),
+                         {user2.id})
+        self.assertEqual(user2.following_among([user1.id, user2.id]), set())
+        self.assertEqual(user1.following_among([]), set())
+
+    def test_following_ids_refresh(self):
+        """Is the cached set of followed ids dropped when follows change?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user2 = User.query.filter(User.username == "TEST_USER2").first()
+
+        self.assertEqual(user1.is_following(user2), False)
+
+        user1.following.append(user2)
+        db.session.commit()
+
+        self.assertEqual(user1.is_following(user2), True)
+
+    def test_timeline_rebuild(self):
+        """Does rebuilding a timeline collect own and followed messages?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user2 = User.query.filter(User.username == "TEST_USER2").first()
+
+        db.session.add(Follows(user_being_followed_id=user2.id,
+                               user_following_id=user1.id))
+        own = Message(text="mine", user_id=user1.id)
+        followed = Message(text="theirs", user_id=user2.id)
+        db.session.add_all([own, followed])
+        db.session.commit()
+
+        self.assertEqual(user1.timeline_ready, False)
+
+        TimelineEntry.rebuild(user1)
+        db.session.commit()
+
+        entries = TimelineEntry.query.filter_by(user_id=user1.id).all()
+        self.assertEqual({e.message_id for e in entries}, {own.id, followed.id})
+        self.assertEqual(user1.timeline_ready, True)
+        self.assertEqual(user1.timeline_complete, True)
+
+    def test_timeline_trimmed_on_delivery(self):
+        """Do deliveries keep timelines to TIMELINE_LENGTH entries?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        messages = [Message(text=f"message {i}", user_id=user1.id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with mock.patch('models.TIMELINE_LENGTH', 3), \
+                mock.patch('models.TIMELINE_TRIM_SHARE', 1):
+            for msg in messages:
+                TimelineEntry.fan_out(msg)
+            db.session.commit()
+
+        entries = TimelineEntry.query.filter_by(user_id=user1.id).all()
+        self.assertEqual({e.message_id for e in entries},
+                         {msg.id for msg in messages[-3:]})
+        self.assertEqual(User.query.get(user1.id).timeline_complete, False)
+
+    def test_backfill_after_unfollow(self):
+        """After a trimmed timeline loses an author, does following someone
+        new keep the other followed users' older messages on the homepage?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user2 = User.query.filter(User.username == "TEST_USER2").first()
+        user3 = User(username="TEST_USER3", email="TEST3@EMAIL.COM",
+                     password="third")
+        user4 = User(username="TEST_USER4", email="TEST4@EMAIL.COM",
+                     password="fourth")
+        db.session.add_all([user3, user4])
+        db.session.commit()
+
+        for followed in (user2, user3):
+            db.session.add(Follows(user_being_followed_id=followed.id,
+                                   user_following_id=user1.id))
+
+        start = datetime(2024, 1, 1)
+        posts = [(user3, 20), (user2, 21), (user2, 22), (user2, 23),
+                 (user1, 30), (user4, 15)]
+        messages = [Message(text=f"at {minute}", user_id=author.id,
+                            timestamp=start + timedelta(minutes=minute))
+                    for author, minute in posts]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with mock.patch('models.TIMELINE_LENGTH', 3), \
+                mock.patch('models.TIMELINE_TRIM_SHARE', 1):
+            for msg in messages[:5]:
+                TimelineEntry.fan_out(msg)
+
+            # unfollow user2, leaving just user1's own message; then follow
+            # user4, whose message is older than that
+            Follows.query.filter_by(user_being_followed_id=user2.id).delete()
+            TimelineEntry.remove_author(user1.id, user2.id)
+            db.session.add(Follows(user_being_followed_id=user4.id,
+                                   user_following_id=user1.id))
+            TimelineEntry.backfill(user1.id, user4.id)
+            db.session.commit()
+
+        user1 = User.query.get(user1.id)
+        user1.timeline_ready = True
+        shown, has_more = timeline_page(user1, None)
+        self.assertEqual([msg.text for msg in shown],
+                         ["at 30", "at 20", "at 15"])
+
+    def test_reconcile_counts(self):
+        """Does reconciling fix counters that drifted from the real rows?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user2 = User.query.filter(User.username == "TEST_USER2").first()
+
+        db.session.add(Follows(user_being_followed_id=user2.id,
+                               user_following_id=user1.id))
+        db.session.add(Message(text="uncounted", user_id=user2.id))
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user2.followers_count, 1)
+        self.assertEqual(user2.messages_count, 1)
+        self.assertEqual(User.reconcile_counts(), 0)
+
     def test_user_authenticate(self):
         """Does authneticate return a user object when given a valid username and password and return Flase when giving a wrong password or username"""
 
@@ -125,6 +263,34 @@ class UserModelTestCase(TestCase):
         self.assertEqual(User.authenticate(user1.username, "xxxx"), False)
         self.assertEqual(User.authenticate("userX", "test"), False)
 
+    def test_authenticate_rehashes(self):
+        """Does logging in upgrade a hash made with an old work factor?"""
+
+        user1 = User.query.filter(User.username == "TEST_USER1").first()
+        user1.password = bcrypt.generate_password_hash("test", 4).decode('UTF-8')
+
+        self.assertEqual(User.authenticate(user1.username, "test"), user1)
+        self.assertTrue(user1.password.startswith(f"$2b${hasher.rounds}$"))
+        self.assertEqual(user1.check_password("test"), True)
+
+    def test_hasher_reconfigured_mid_hash(self):
+        """Does a hash running while the pool is rebuilt give its slot
+        back to the pool it came from?"""
+
+        rounds = hasher.rounds
+
+        def reconfigure():
+            hasher.configure(rounds, workers=1, queue=0, wait=0)
+            return "done"
+
+        try:
+            self.assertEqual(hasher._run(reconfigure), "done")
+            # the new pool's only slot is still free
+            self.assertTrue(hasher._slots.acquire(blocking=False))
+            hasher._slots.release()
+        finally:
+            hasher.init_app(app)
+
     def test_signup_positive(self):
         """does signup() successfully create a new user with valid credentials?"""
 
@@ -1,13 +1,16 @@
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
-from models import User, Message, Follows, db
+from models import User, Message, Follows, Likes, TimelineEntry, db
 from flask_bcrypt import Bcrypt
+from passwords import hasher
 
 bcrypt = Bcrypt()
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, fragment_cache
+from jobs import jobs
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
@@ -64,6 +67,20 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
 
 
+    def test_login_when_hasher_busy(self):
+        "Does POST /login fail fast with a 503 when hashing is saturated?"
+        hasher.configure(hasher.rounds, workers=1, queue=0, wait=0)
+        hasher._slots.acquire()
+
+        try:
+            with app.test_client() as client:
+                response = client.post('/login', data={"username": "TEST_USER1",
+                                                       "password": "testtest"})
+                self.assertEqual(response.status_code, 503)
+        finally:
+            hasher.init_app(app)
+
+
     def test_logout(self):
         "Does GET /logout redirect home?"
         with app.test_client() as client:
@@ -79,6 +96,46 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
 
 
+    def test_search_users(self):
+        """Does searching rank usernames starting with the search first?"""
+        db.session.add(User(username="a_test_fan", email="fan@email.com",
+                            password="test"))
+        db.session.commit()
+
+        with app.test_client() as client:
+            response = client.get('/users?q=test')
+            html = response.get_data(as_text=True)
+
+            self.assertLess(html.index('@TEST_USER2'), html.index('@a_test_fan'))
+
+            # wildcards in the search match literally
+            response = client.get('/users?q=t%25user')
+            self.assertIn('no users found', response.get_data(as_text=True))
+
+
+    def test_list_users_paginates(self):
+        """Does GET /users cap results and continue with a cursor?"""
+        db.session.add_all([User(username=f"user{i:02}",
+                                 email=f"user{i}@email.com", password="test")
+                            for i in range(60)])
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get('/users').get_data(as_text=True)
+
+            # the two setUp users sort first
+            self.assertEqual(html.count('class="card user-card"'), 60)
+            self.assertIn('@user57', html)
+            self.assertNotIn('@user58', html)
+
+            cursor = html.split('after=')[1].split('"')[0]
+            html = client.get(f'/users?after={cursor}').get_data(as_text=True)
+
+            self.assertIn('@user58', html)
+            self.assertIn('@user59', html)
+            self.assertNotIn('@user57', html)
+
+
     def test_user_detail(self):
         "Does GET /users/<user-id> show the details of that user?"
         with app.test_client() as client:
@@ -105,6 +162,41 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
 
 
+    def test_followers_paginate(self):
+        """Do follower pages cap results, continue with a cursor, and show
+        whether the viewer follows each user?"""
+        followers = [User(username=f"fan{i:02}", email=f"fan{i}@email.com",
+                          password="test") for i in range(61)]
+        db.session.add_all(followers)
+        db.session.commit()
+        db.session.add_all(
+            [Follows(user_being_followed_id=self.other_user_id,
+                     user_following_id=fan.id) for fan in followers]
+            + [Follows(user_being_followed_id=followers[0].id,
+                       user_following_id=self.user_id)])
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            html = client.get(f'/users/{self.other_user_id}/followers'
+                              ).get_data(as_text=True)
+
+            # followers come in id order, which is signup order here
+            self.assertEqual(html.count('class="card user-card"'), 60)
+            self.assertIn('@fan59', html)
+            self.assertNotIn('@fan60', html)
+            self.assertEqual(html.count('Unfollow'), 1)
+
+            cursor = html.split('after=')[1].split('"')[0]
+            html = client.get(f'/users/{self.other_user_id}/followers'
+                              f'?after={cursor}').get_data(as_text=True)
+
+            self.assertIn('@fan60', html)
+            self.assertNotIn('@fan59', html)
+
+
     def test_redirect_following(self):
         "Does GET /users/<user-id>/following with no user.id in the session redirects us to the homepage so we can't access the list of following users?"
         with app.test_client()as client:
@@ -158,6 +250,100 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(testuser.is_following(followed), False)
             
     
+    def test_follow_updates_timeline(self):
+        """Does following backfill the timeline and unfollowing clear it?"""
+        # a fresh, complete timeline (incomplete ones only take newer
+        # messages than they already hold)
+        user = User.query.get(self.user_id)
+        user.timeline_ready = user.timeline_complete = True
+        msg = Message(text="Backfilled", user_id=self.other_user_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            client.post(f'/users/follow/{self.other_user_id}')
+            entry = TimelineEntry.query.get((self.user_id, msg_id))
+            self.assertIsNotNone(entry)
+
+            client.post(f'/users/stop-following/{self.other_user_id}')
+            entry = TimelineEntry.query.get((self.user_id, msg_id))
+            self.assertIsNone(entry)
+
+
+    def test_user_messages_paginate(self):
+        """Does GET /users/<user-id> page older messages with a cursor?"""
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"msg {i}", user_id=self.user_id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(101)
+        ])
+        db.session.commit()
+
+        with app.test_client() as client:
+            response = client.get(f'/users/{self.user_id}')
+            html = response.get_data(as_text=True)
+
+            self.assertIn('msg 100', html)
+            self.assertNotIn('msg 0<', html)
+            self.assertIn('Older', html)
+
+            cursor = html.split('before=')[1].split('"')[0]
+            response = client.get(f'/users/{self.user_id}?before={cursor}')
+            html = response.get_data(as_text=True)
+
+            self.assertIn('msg 0<', html)
+            self.assertNotIn('msg 1<', html)
+            self.assertNotIn('Older', html)
+
+
+    def test_bad_cursor(self):
+        """Does a malformed cursor give a 400?"""
+        with app.test_client() as client:
+            response = client.get(f'/users/{self.user_id}?before=nonsense')
+            self.assertEqual(response.status_code, 400)
+
+
+    def test_homepage_reads_past_timeline(self):
+        """Does the homepage still show messages missing from a built
+        timeline?"""
+        user = User.query.get(self.user_id)
+        user.timeline_ready = True
+        user.timeline_complete = False
+        db.session.add(Message(text="Not fanned out", user_id=self.user_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            response = client.get('/')
+            self.assertIn("Not fanned out", response.get_data(as_text=True))
+
+
+    def test_follow_counters(self):
+        """Do following and unfollowing keep both users' counters right?"""
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            client.post(f'/users/follow/{self.other_user_id}')
+
+            self.assertEqual(User.query.get(self.user_id).following_count, 1)
+            self.assertEqual(
+                User.query.get(self.other_user_id).followers_count, 1)
+
+            client.post(f'/users/stop-following/{self.other_user_id}')
+
+            self.assertEqual(User.query.get(self.user_id).following_count, 0)
+            self.assertEqual(
+                User.query.get(self.other_user_id).followers_count, 0)
+
+
     def test_show_user_profile(self):
         """Does GET /users/profile show the edit user profile form? """
         with app.test_client()as client:
@@ -171,6 +357,27 @@ class UserViewsTestCase(TestCase):
             self.assertIn('<form method="POST" id="user_form">', html)
 
     
+    def test_cached_user_refreshed(self):
+        """Does an edited profile show up on the next page, not a cached
+        copy?"""
+        with app.test_client()as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            client.get('/')
+
+            test_user = User.query.get(self.user_id)
+            test_user.password = bcrypt.generate_password_hash("test").decode('UTF-8')
+            db.session.commit()
+
+            client.post('/users/profile', data={"username": "RENAMED",
+                                                "email": "CHANGE@EMAIL.COM",
+                                                "password": "test"})
+
+            response = client.get('/')
+            self.assertIn('@RENAMED', response.get_data(as_text=True))
+
+
     def test_submit_user_profile(self):
         """Does POST /users/profile submit the form data?"""
         with app.test_client()as client:
@@ -190,3 +397,162 @@ class UserViewsTestCase(TestCase):
             
             self.assertEqual(response.status_code, 200)
             self.assertEqual(len(db.session.query(User.username).filter(User.username == "TESTCHANGE").first()), 1)
+
+
+    def test_profile_not_modified(self):
+        """Does a profile the client already has get a bodyless 304, until
+        something shown on it changes?"""
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            url = f'/users/{self.other_user_id}'
+            response = client.get(url)
+            etag = response.headers['ETag']
+            self.assertIn('private', response.headers['Cache-Control'])
+
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+
+            # the Follow button turns into Unfollow
+            client.post(f'/users/follow/{self.other_user_id}')
+
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+
+    def test_static_cache_policy(self):
+        """Are versioned static files cacheable forever, and others briefly?"""
+        with app.test_client() as client:
+            response = client.get('/static/stylesheets/style.css?v=abc')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            response.close()
+
+            response = client.get('/static/stylesheets/style.css')
+            self.assertNotIn('immutable', response.headers['Cache-Control'])
+            self.assertIn(f"max-age={app.config['STATIC_MAX_AGE']}",
+                          response.headers['Cache-Control'])
+            response.close()
+
+
+    def test_no_http_cache_option(self):
+        """Does NO_HTTP_CACHE bring back the blanket no-store headers?"""
+        app.config['NO_HTTP_CACHE'] = True
+        try:
+            with app.test_client() as client:
+                response = client.get(f'/users/{self.user_id}')
+                self.assertIn('no-store', response.headers['Cache-Control'])
+                self.assertNotIn('ETag', response.headers)
+        finally:
+            app.config['NO_HTTP_CACHE'] = False
+
+
+    def test_message_fragments_follow_profile_edits(self):
+        """Are cached message fragments reused, then dropped when their
+        author edits their profile?"""
+        db.session.add(Message(text="Cached message", user_id=self.user_id))
+        test_user = User.query.get(self.user_id)
+        test_user.password = bcrypt.generate_password_hash("test").decode('UTF-8')
+        db.session.commit()
+        fragment_cache.clear()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            client.get(f'/users/{self.user_id}')
+            self.assertEqual(len(fragment_cache), 1)
+
+            client.post('/users/profile', data={"username": "RENAMED",
+                                                "email": "CHANGE@EMAIL.COM",
+                                                "password": "test"})
+            self.assertEqual(len(fragment_cache), 0)
+
+            response = client.get(f'/users/{self.user_id}')
+            html = response.get_data(as_text=True)
+            self.assertIn('Cached message', html)
+            self.assertNotIn('@TEST_USER1', html)
+
+
+    def delete_first_user(self):
+        """Connect the two users every way there is, then have the first
+        delete their account. Returns the second user, reloaded."""
+        msg = Message(text="Doomed", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.user_id,
+                    user_following_id=self.other_user_id),
+            Follows(user_being_followed_id=self.other_user_id,
+                    user_following_id=self.user_id),
+            Likes(user_id=self.other_user_id, message_id=msg.id),
+        ])
+        db.session.commit()
+        TimelineEntry.fan_out(msg)
+        User.reconcile_counts()
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user_id
+
+            response = client.post('/users/delete')
+            self.assertEqual(response.status_code, 302)
+
+        # run any queued purge
+        jobs.run_pending()
+        db.session.remove()
+
+        self.assertIsNone(User.query.get(self.user_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        return User.query.get(self.other_user_id)
+
+
+    def test_delete_user(self):
+        """Does deleting an account remove its rows and release counters?"""
+        other = self.delete_first_user()
+
+        self.assertEqual((other.followers_count, other.following_count,
+                          other.likes_count), (0, 0, 0))
+
+
+    def test_delete_big_user_without_queue(self):
+        """With the queue off, is a big account's name freed at once and
+        the account purged after the request?"""
+        app.config['PURGE_IN_BACKGROUND_OVER'] = 0
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.user_id
+
+                client.post('/users/delete')
+
+            self.assertIsNone(
+                User.query.filter_by(username="TEST_USER1").first())
+
+            # wait for the background thread to finish the purge
+            jobs._background.submit(lambda: None).result()
+            db.session.remove()
+            self.assertIsNone(User.query.get(self.user_id))
+        finally:
+            app.config['PURGE_IN_BACKGROUND_OVER'] = 5000
+
+
+    def test_delete_big_user_in_background(self):
+        """Is a big account purged by a job after the request returns?"""
+        app.config['PURGE_IN_BACKGROUND_OVER'] = 0
+        jobs.queued = True
+        try:
+            other = self.delete_first_user()
+        finally:
+            app.config['PURGE_IN_BACKGROUND_OVER'] = 5000
+            jobs.queued = False
+
+        self.assertEqual((other.followers_count, other.following_count,
+                          other.likes_count), (0, 0, 0))